@@ -0,0 +1,14 @@
+# Lets the directory run as a program: python electrification <command>, or python -m electrification.
+# The modules import each other by their plain names, so this directory goes on the path first.
+# Process pool workers started with spawn or forkserver import this file again as __mp_main__; the guard keeps
+# them from running the command line a second time.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cli
+
+if __name__ == "__main__":
+    sys.exit(cli.main())
@@ -1,175 +1,96 @@
 # Analysis
+# The analysis modules pull in pandas, SciPy and statsmodels, so each function imports what it needs when called.
 
-import pandas as pd
-import numpy as np
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error, r2_score
-import sqlite3
-from statsmodels.tsa.stattools import grangercausalitytests
-import statsmodels.api as sm
-conn = sqlite3.connect("eia.db")
-cur = conn.cursor()
+import store
+from panel import load_panel
 
 # Test whether the electricity/energy price ratio Granger causes electrification rates in the US.
 def granger_causality():
+    import granger
     maxlag = 15 # Maximum number of years to test for a lag
 
-    df = pd.read_sql_query("SELECT electrification.State, electrification.Year, electrification.Value AS Elec, electricity_price_share.Value as ElecPriceShare \
-        FROM electrification JOIN electricity_price_share ON electrification.Year = electricity_price_share.Year AND electrification.State = electricity_price_share.State \
-        WHERE electrification.State = 'United States';",conn)
-
-    test_result = grangercausalitytests(df[["ElecPriceShare", "Elec"]].diff().dropna(), maxlag=maxlag, verbose=False)
-    min_result = min( [test_result[i][0]["ssr_chi2test"][1] for i in range(1,maxlag+1)] )
-    for i in range(maxlag):
-        print( test_result[i+1][0]["ssr_chi2test"][1] )
+    df = load_panel().time_series(["electrification", "electricity_price_share"]).dropna()
+    test_result = granger.granger_tests(df["electricity_price_share"], df["electrification"], maxlag=maxlag)
+    min_result = min( [result["Chi2P"] for result in test_result] )
+    for result in test_result:
+        print( result["Chi2P"] )
     print(min_result)
+
+# Granger tests for every state and configured pair of series, run in parallel and stored in granger_results.
+def granger_causality_states(pairs=None, maxlag=15):
+    import granger
+    return granger.granger_sweep(pairs or granger.granger_pairs, maxlag=maxlag)
     
 # Regression of electrification in terms of electricity/price ratio across states.
-def price_elec_regression():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, electricity_price_share.Value AS ElecPriceShare \
-        FROM electrification JOIN electricity_price_share \
-        ON electrification.Year = electricity_price_share.Year AND electrification.State = electricity_price_share.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States';",conn)
-    X = df["ElecPriceShare"].to_numpy().reshape(-1,1)
-    y = df["Elec"].to_numpy().reshape(-1,1)
-    reg = LinearRegression().fit(X, y)
-    predicted = reg.predict(X)
-    
-    X = sm.add_constant(X)
-    mod = sm.OLS(y,X)
-    fii = mod.fit()
-    print(fii.summary2())
+def price_elec_regression(year=2019):
+    import regress
+    print(regress.fit_summary("electricity_price_share", "electrification", year).summary2())
+
+# Resampling inference for the price regression, which has only about 50 states to go on.
+def price_elec_inference(year=2019):
+    regression_inference("electricity_price_share", "electrification", year)
 
 # Regression of electrification in terms of GDP per capita across states.
-def gdp_elec_regression():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, gdp_per_capita.Value AS GDPCap \
-        FROM electrification JOIN gdp_per_capita \
-        ON electrification.Year = gdp_per_capita.Year AND electrification.State = gdp_per_capita.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States' AND electrification.State != 'District of Columbia';",conn)
-    X = df["GDPCap"].to_numpy().reshape(-1,1)
-    y = df["Elec"].to_numpy().reshape(-1,1)
-    reg = LinearRegression().fit(X, y)
-    predicted = reg.predict(X)
-    
-    X = sm.add_constant(X)
-    mod = sm.OLS(y,X)
-    fii = mod.fit()
-    print(fii.summary2())
+def gdp_elec_regression(year=2019):
+    import regress
+    print(regress.fit_summary("gdp_per_capita", "electrification", year, exclude=("United States", "District of Columbia")).summary2())
         
 # Regression of electrification in terms of the growth in total energy consumption from 2009 to 2019 across states.
-def energy_elec_regression():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, energy.Value AS Energy \
-        FROM electrification JOIN energy \
-        ON electrification.Year = energy.Year AND electrification.State = energy.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States';",conn)
-    df2009 = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, energy.Value AS Energy \
-        FROM electrification JOIN energy \
-        ON electrification.State = energy.State \
-        WHERE electrification.Year = '2019' AND energy.Year = '2009' AND electrification.State != 'United States';",conn)
-    df["EnergyDiff"] = (df["Energy"] - df2009["Energy"])/df2009["Energy"]
-    X = df["EnergyDiff"].to_numpy().reshape(-1,1)
-    y = df["Elec"].to_numpy().reshape(-1,1)
-    reg = LinearRegression().fit(X, y)
-    predicted = reg.predict(X)
-    
-    X = sm.add_constant(X)
-    mod = sm.OLS(y,X)
-    fii = mod.fit()
-    print(fii.summary2())
+# Growth and electrification are joined on State, so states missing from either year drop out of the fit.
+def energy_elec_regression(start=2009, end=2019):
+    import regress
+    import rolling
+    panel = load_panel(["electrification", "energy"])
+    growth = rolling.growth_rates(["energy"], end - start, panel=panel).xs(end, level="Year")
+    df = panel.cross_section(["electrification"], end).join(growth["energy"].rename("EnergyDiff"), how="inner")
+    print(regress.fit_arrays(df["EnergyDiff"], df["electrification"], "EnergyDiff", "electrification").summary2())
     
-def regression(regressor, dependent):
-    df = pd.read_sql_query("SELECT "+dependent"+.State as State, "+dependent+".Value AS Dependent, "+predictor+".Value AS Predictor \
-        FROM "+dependent+" JOIN "+predictor+" \
-        ON "+dependent+".Year = "+predictor+".Year AND "+dependent+".State = "+predictor+".State \
-        WHERE "+dependent+".Year = '2019' AND "+dependent+".State != 'United States';",conn)
-    X = df["Predictor"].to_numpy().reshape(-1,1)
-    y = df["Dependent"].to_numpy().reshape(-1,1)
-    reg = LinearRegression().fit(X, y)
-    predicted = reg.predict(X)
+def regression(predictor, dependent, year=2019):
+    import regress
+    print(regress.fit_summary(predictor, dependent, year).summary2())
+
+# Coefficients, standard errors and R2 for every combination of predictors, dependents and years, fitted at once.
+def regression_sweep(predictors, dependents, years=range(1960,2020)):
+    import regress
+    return regress.batch_regression(predictors, dependents, years)
     
-    X = sm.add_constant(X)
-    mod = sm.OLS(y,X)
-    fii = mod.fit()
-    print(fii.summary2())
+# Bootstrap interval, permutation p-value and the most influential states for one cross-state regression.
+def regression_inference(predictor, dependent, year=2019, resamples=10000, seed=0):
+    import resample
+    print(resample.resample([predictor], [dependent], [year], resamples, seed).iloc[0].to_string())
+    influence = resample.influence([predictor], [dependent], [year])
+    print(influence.reindex(influence["Influence"].abs().sort_values(ascending=False).index).head(5)[["State", "Slope", "Influence"]].to_string(index=False))
     
+# Rolling regression of electrification on the electricity/energy price ratio within each state, and the
+# year-over-year elasticity of electrification with respect to the ratio, for every state and year.
+def price_elec_rolling(window=10):
+    import rolling
+    panel = load_panel(["electricity_price_share", "electrification"])
+    result = rolling.rolling_regression("electricity_price_share", "electrification", window, panel=panel).join(
+        rolling.elasticities("electricity_price_share", "electrification", size=window, panel=panel))
+    print(result.xs(panel.years[-1], level="Year").dropna(subset=["Slope"]).to_string())
+
 # Decompose variance in electrification into variance between secctors and variance within sectors.
-def decomposition():
-    df_elecrification = pd.read_sql_query("SELECT * FROM electrification WHERE Year = '2019' AND State != 'United States';",conn)
-    df_shares = [
-        pd.read_sql_query("SELECT * FROM residential_share WHERE Year = '2019' and State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_share WHERE Year = '2019' and State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_share WHERE Year = '2019' and State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_share WHERE Year = '2019' and State != 'United States';",conn)
-    ]
-    df_elec = [
-        pd.read_sql_query("SELECT * FROM residential_electricity WHERE Year = '2019' and State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_electricity WHERE Year = '2019' AND State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_electricity WHERE Year = '2019' and State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_electricity WHERE Year = '2019' and State != 'United States';",conn)
-    ]
-    df_energy = [
-        pd.read_sql_query("SELECT * FROM residential_energy WHERE Year = '2019' and State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_energy WHERE Year = '2019' and State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_energy WHERE Year = '2019' and State != 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_energy WHERE Year = '2019' and State != 'United States';",conn)
-    ]
-    df_shares_us = [
-        pd.read_sql_query("SELECT * FROM residential_share WHERE Year = '2019' and State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_share WHERE Year = '2019' and State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_share WHERE Year = '2019' and State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_share WHERE Year = '2019' and State = 'United States';",conn)
-    ]
-    df_elec_us = [
-        pd.read_sql_query("SELECT * FROM residential_electricity WHERE Year = '2019' and State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_electricity WHERE Year = '2019' AND State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_electricity WHERE Year = '2019' and State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_electricity WHERE Year = '2019' and State = 'United States';",conn)
-    ]
-    df_energy_us = [
-        pd.read_sql_query("SELECT * FROM residential_energy WHERE Year = '2019' and State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_energy WHERE Year = '2019' and State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_energy WHERE Year = '2019' and State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_energy WHERE Year = '2019' and State = 'United States';",conn)
-    ]
-    # Another way of calculating electrification
-    df_elec_constant_shares = sum([df_shares_us[i]["Value"][0]*df_elec[i]["Value"]/df_energy[i]["Value"] for i in range(4)])
-    elec_constant_shares = np.var(df_elec_constant_shares) # 0.0005997759446552342
-    df_elec_constant_rate = sum([df_shares[i]["Value"]*df_elec_us[i]["Value"][0]/df_energy_us[i]["Value"][0] for i in range(4)])
-    elec_constant_rate = np.var(df_elec_constant_rate) # 0.00031628128005427774
-    elec_overall = np.var(df_elecrification["Value"]) # 0.0008719045137182862
-    print("Variance due to varying electrification rates within sectors: "+str( (elec_constant_shares+(elec_overall-elec_constant_rate)) / 2.0 / elec_overall) )
+# The decomposition is read from the rollup tables, which are brought up to date first if the data changed.
+def decomposition(year=2019):
+    import rollup
+    conn = store.connect()
+    try:
+        rollup.refresh(conn)
+        conn.commit()
+        result = rollup.decomposition(conn, [year])
+    finally:
+        conn.close()
+    print("Variance due to varying electrification rates within sectors: "+str(result["WithinShare"].iloc[0]))
     
-def decomposition_time():
-    df_electrification = pd.read_sql_query("SELECT * FROM electrification WHERE State = 'United States';",conn)
-    df_shares_us = [
-        pd.read_sql_query("SELECT * FROM residential_share WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_share WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_share WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_share WHERE State = 'United States';",conn)
-    ]
-    df_elec_us = [
-        pd.read_sql_query("SELECT * FROM residential_electricity WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_electricity WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_electricity WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_electricity WHERE State = 'United States';",conn)
-    ]
-    df_energy_us = [
-        pd.read_sql_query("SELECT * FROM residential_energy WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM commercial_energy WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM industrial_energy WHERE State = 'United States';",conn),
-        pd.read_sql_query("SELECT * FROM transportation_energy WHERE State = 'United States';",conn)
-    ]
-    in_sector_diff = []
-    for i in range(1960,2019): # Do range(1960,2019) for the full version
-        index = i-1960
-        in_sector_difference1 = sum([df_shares_us[i]["Value"][index]*df_elec_us[i]["Value"][index+1]/df_energy_us[i]["Value"][index+1] for i in range(4)]) - \
-                                sum([df_shares_us[i]["Value"][index]*df_elec_us[i]["Value"][index]/df_energy_us[i]["Value"][index] for i in range(4)])
-        in_sector_difference2 = sum([df_shares_us[i]["Value"][index+1]*df_elec_us[i]["Value"][index+1]/df_energy_us[i]["Value"][index+1] for i in range(4)]) - \
-                                sum([df_shares_us[i]["Value"][index+1]*df_elec_us[i]["Value"][index]/df_energy_us[i]["Value"][index] for i in range(4)])
-        in_sector_diff.append( (in_sector_difference1+in_sector_difference2)/ 2.0 / (df_electrification["Value"][1] - df_electrification["Value"][0]) )
-    print(sum(in_sector_diff)/len(in_sector_diff))
+# Average share of year-to-year change in US electrification that comes from change within sectors.
+def decomposition_time(start=1960, end=2019):
+    import decompose
+    result = decompose.decompose("time", start=start, end=end, states=["United States"])
+    print(result["WithinShare"].mean())
 
-price_elec_regression()
-gdp_elec_regression()
-decomposition()
-decomposition_time()
\ No newline at end of file
+if __name__ == "__main__":
+    price_elec_regression()
+    gdp_elec_regression()
+    decomposition()
+    decomposition_time()
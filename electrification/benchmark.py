@@ -0,0 +1,322 @@
+# Benchmarks for the whole pipeline on synthetic data.
+# A SEDS-shaped dataset is generated for any number of states, years and extra series and served by a local
+# stand-in for the EIA API. The pipeline then runs stage by stage in a temporary directory:
+#   fetch      every series from the local endpoint through fetch.Fetcher
+#   insert     staged rows written to the observations table
+#   derive     derived series evaluated
+#   query      panels and cross sections read back
+#   fit        batch regressions across every pair of series and year
+#   decompose  both shift-share decompositions
+#   granger    Granger tests for every state
+#   render     every figure
+# Each stage records wall time and, unless disabled, peak memory allocated by Python (tracemalloc, which adds
+# some overhead and does not see worker processes). Results are written as JSON, and two result files can be
+# compared stage by stage to catch regressions before deploying:
+#   python benchmark.py run --states 52 --years 61 --out before.json
+#   python benchmark.py compare before.json after.json
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import build_db
+import fetch
+import store
+
+last_year = 2020
+stage_names = ["fetch", "insert", "derive", "query", "fit", "decompose", "granger", "render"]
+
+###### Synthetic data
+
+# State names and codes: the real ones first, the US aggregate always included, then made-up states.
+def synthetic_states(count):
+    real = [(name, code) for name, code in build_db.state_codes.items() if name != "United States"]
+    states = [("United States", "US")] + real[:count-1]
+    states += [("State "+format(i, "03d"), "Z"+format(i, "03d")) for i in range(len(states)+1, count+1)]
+    return dict(states)
+
+# The downloaded (dataset, table) pairs plus extra made-up series.
+def synthetic_series_list(extra):
+    return list(build_db.state_series) + [("SYN"+format(i, "03d"), "synthetic_"+format(i, "03d")) for i in range(1, extra+1)]
+
+# Series info dicts shaped like EIA responses, newest year first, keyed by series id.
+# Electricity series are a fraction of the matching energy series so that shares and rates stay in range.
+def synthetic_data(states, series, years, seed=0):
+    rng = random.Random(seed)
+    year_list = list(range(last_year-years+1, last_year+1))
+    data = {}
+    for state, code in states.items():
+        levels = {}
+        for dataset, table in sorted(series, key=lambda pair: "electricity" in pair[1]):
+            energy = table.replace("electricity", "energy")
+            if energy != table and energy in levels:
+                fraction = rng.uniform(0.05, 0.4)
+                values = [level*fraction*rng.uniform(0.95, 1.05) for level in levels[energy]]
+            else:
+                level, growth = rng.uniform(10, 1000), rng.uniform(-0.01, 0.03)
+                values = [level*(1+growth)**t*rng.uniform(0.97, 1.03) for t in range(len(year_list))]
+            levels[table] = values
+            data[fetch.seds_series_id(dataset, code)] = {
+                "series_id": fetch.seds_series_id(dataset, code),
+                "updated": "2021-06-25T00:00:00-0400",
+                "data": [[str(year), value] for year, value in reversed(list(zip(year_list, values)))]
+            }
+    return data
+
+###### Local EIA endpoint
+
+# Serves /series/?series_id=... and /updates/ from a dict of series info, on a free local port.
+class FakeEIA:
+    def __init__(self, data):
+        self.data = data
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # Keep connections alive, as the EIA does
+            disable_nagle_algorithm = True # Headers and body go out as separate writes
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if url.path.startswith("/updates"):
+                    first, rows = int(query.get("firstrow", 0)), int(query.get("rows", 10000))
+                    page = [{"series_id": key, "updated": info["updated"]} for key, info in sorted(server.data.items())[first:first+rows]]
+                    payload = {"updates": page}
+                elif query.get("series_id") in server.data:
+                    payload = {"series": [server.data[query["series_id"]]]}
+                else:
+                    payload = {"data": {"error": "invalid series_id"}}
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = "http://127.0.0.1:"+str(self.httpd.server_address[1])+"/series/"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+###### Stages
+
+# Time fn and, with memory, record the peak of memory allocated while it ran.
+def measure(fn, memory=True):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        items = fn()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak, "items": items}
+
+# Point build_db at a database in the working directory and at the synthetic states and series.
+@contextmanager
+def pipeline(states, series, years):
+    saved = build_db.state_codes, build_db.state_series, build_db.year_range, build_db.conn
+    build_db.state_codes, build_db.state_series = states, series
+    build_db.year_range = [last_year-years+1, last_year+1]
+    build_db.conn = store.connect()
+    build_db.staged_rows.clear()
+    try:
+        build_db.create_tables()
+        for dataset, table in series:
+            store.add_series(build_db.db(), table)
+        build_db.db().commit()
+        yield
+    finally:
+        build_db.conn.close()
+        build_db.state_codes, build_db.state_series, build_db.year_range, build_db.conn = saved
+        build_db.staged_rows.clear()
+
+# Run every stage once in a fresh temporary directory. Returns {stage: {seconds, peak_bytes, items}}.
+# Modules are imported up front so that import time is not counted in any stage.
+def run_once(states, series, years, seed=0, processes=None, concurrency=8, memory=True):
+    import pandas
+    import requests
+    import decompose
+    import granger
+    import panel
+    import plots
+    import regress
+    data = synthetic_data(states, series, years, seed)
+    cwd = os.getcwd()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="electrification-benchmark-") as workdir, FakeEIA(data) as server:
+        os.chdir(workdir)
+        try:
+            with pipeline(states, series, years):
+                jobs = build_db.state_jobs()
+                fetched = {}
+
+                def fetch_stage():
+                    with fetch.Fetcher("benchmark", concurrency=concurrency, rate=0, base_url=server.base_url) as fetcher:
+                        fetched.update(fetcher.fetch_all([build_db.job_series_id(job) for job in jobs]))
+                    return len(fetched)
+
+                def insert_stage():
+                    for job in jobs:
+                        build_db.add_state_data(*job, series_data=fetched[build_db.job_series_id(job)]["data"])
+                    for state in states:
+                        for table in build_db.zero_tables:
+                            build_db.add_state_zero(state, table)
+                    with build_db.bulk_load():
+                        return sum(build_db.write_staged_rows().values())
+
+                def derive_stage():
+                    with build_db.bulk_load():
+                        return len(build_db.add_derived_tables())
+
+                def query_stage():
+                    panel.clear_cache()
+                    loaded = panel.load_panel()
+                    store.load_series(build_db.db(), ["electrification", "electricity_price_share"], year=last_year-1)
+                    store.load_series(build_db.db(), ["electrification", "gdp_per_capita"], state="United States")
+                    return int(loaded.values.size)
+
+                def fit_stage():
+                    names = panel.load_panel().series
+                    return len(regress.batch_regression(names, names, panel.load_panel().years))
+
+                def decompose_stage():
+                    return len(decompose.decompose("time", pairs="all")) + len(decompose.decompose("states"))
+
+                def granger_stage():
+                    return len(granger.granger_sweep(processes=processes, write=False))
+
+                def render_stage():
+                    return len(plots.render_all(outdir="figures", processes=processes, force=True))
+
+                for name, stage in zip(stage_names, [fetch_stage, insert_stage, derive_stage, query_stage, fit_stage, decompose_stage, granger_stage, render_stage]):
+                    results[name] = measure(stage, memory)
+        finally:
+            os.chdir(cwd)
+            panel.clear_cache()
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Run the whole pipeline repeat times. Each stage reports its fastest time and largest peak across runs.
+def run(states=52, years=61, series=0, repeat=1, seed=0, processes=None, concurrency=8, memory=True):
+    state_list, series_list = synthetic_states(states), synthetic_series_list(series)
+    runs = [run_once(state_list, series_list, years, seed, processes, concurrency, memory) for i in range(repeat)]
+    stages = {}
+    for name in stage_names:
+        seconds = min(result[name]["seconds"] for result in runs)
+        peaks = [result[name]["peak_bytes"] for result in runs if result[name]["peak_bytes"] is not None]
+        items = runs[0][name]["items"]
+        stages[name] = {
+            "seconds": round(seconds, 6),
+            "peak_bytes": max(peaks) if peaks else None,
+            "items": items,
+            "items_per_second": round(items/seconds, 2) if seconds else None
+        }
+    return {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {"states": states, "years": years, "series": len(series_list), "repeat": repeat, "seed": seed,
+            "processes": processes, "concurrency": concurrency, "memory": memory},
+        "stages": stages
+    }
+
+# Stage by stage comparison of two result dicts. A stage regresses when it is slower, or uses more peak memory,
+# than the baseline by more than tolerance (a fraction).
+def compare(baseline, current, tolerance=0.1):
+    rows = []
+    for name in stage_names:
+        if name not in baseline["stages"] or name not in current["stages"]:
+            continue
+        base, new = baseline["stages"][name], current["stages"][name]
+        time_ratio = new["seconds"]/base["seconds"] if base["seconds"] else None
+        memory_ratio = new["peak_bytes"]/base["peak_bytes"] if base["peak_bytes"] and new["peak_bytes"] is not None else None
+        rows.append({
+            "stage": name,
+            "baseline_seconds": base["seconds"],
+            "seconds": new["seconds"],
+            "time_ratio": time_ratio,
+            "baseline_peak_bytes": base["peak_bytes"],
+            "peak_bytes": new["peak_bytes"],
+            "memory_ratio": memory_ratio,
+            "regressed": any(ratio is not None and ratio > 1+tolerance for ratio in [time_ratio, memory_ratio])
+        })
+    return rows
+
+def ratio_text(ratio):
+    return "-" if ratio is None else format(ratio, ".2f")+"x"
+
+def megabytes(count):
+    return "-" if count is None else format(count/2**20, ".1f")+" MB"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the electrification pipeline on synthetic data.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("run", help="run the benchmarks")
+    command.add_argument("--states", type=int, default=52, help="number of states, including the US aggregate")
+    command.add_argument("--years", type=int, default=61, help="number of years, ending in "+str(last_year))
+    command.add_argument("--series", type=int, default=0, help="extra synthetic series per state")
+    command.add_argument("--repeat", type=int, default=1, help="runs to take the fastest of")
+    command.add_argument("--seed", type=int, default=0, help="seed for the synthetic data")
+    command.add_argument("--processes", type=int, default=None, help="worker processes for Granger tests and figures")
+    command.add_argument("--concurrency", type=int, default=8, help="requests in flight while fetching")
+    command.add_argument("--no-memory", action="store_true", help="do not trace memory")
+    command.add_argument("--out", default=None, help="write results to this JSON file")
+    command = commands.add_parser("compare", help="compare two result files")
+    command.add_argument("baseline", help="results to compare against")
+    command.add_argument("current", help="new results")
+    command.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown or memory growth, as a fraction")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        result = run(args.states, args.years, args.series, args.repeat, args.seed, args.processes, args.concurrency, not args.no_memory)
+        for name, stage in result["stages"].items():
+            print(name+"\t"+format(stage["seconds"], ".3f")+" s\t"+megabytes(stage["peak_bytes"])+"\t"+str(stage["items"])+" items")
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(result, f, indent=1)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline["params"] != current["params"]:
+        print("Parameters differ: "+json.dumps(baseline["params"])+" vs "+json.dumps(current["params"]))
+    rows = compare(baseline, current, args.tolerance)
+    for row in rows:
+        print(row["stage"]+"\t"+format(row["baseline_seconds"], ".3f")+" -> "+format(row["seconds"], ".3f")+" s ("+ratio_text(row["time_ratio"])+")\t"
+            +megabytes(row["baseline_peak_bytes"])+" -> "+megabytes(row["peak_bytes"])+" ("+ratio_text(row["memory_ratio"])+")"
+            +("\tREGRESSED" if row["regressed"] else ""))
+    return 1 if any(row["regressed"] for row in rows) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,46 @@
 # This code populates the database.
 # Acquire an api key from the EIA here: https://www.eia.gov/opendata/qb.php
 # Create a separate file 'api_key.py' with one line as follows: api_key = "<api key acquired above>"
+# or set the EIA_API_KEY environment variable. The key is only needed when data is fetched from the EIA.
 
-import requests
-import sqlite3
-import pandas as pd
-import api_key # API key can be freely obtained from the EIA.
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+import cache
+import derived
+import fetch
+import instrument
+import rollup
+import sources
+import store
+import validate
 
 year_range = [1960,2021] # The first year, followed by one more than the last year
+concurrency = 8 # Number of EIA requests in flight at once
+use_cache = True # Keep raw EIA responses on disk in cache.cache_dir
 
-conn = sqlite3.connect("eia.db")
-cur = conn.cursor()
+conn = None # Opened on first use by db()
+
+staged_rows = {} # Rows waiting to be written, by table
+
+def db():
+    global conn
+    if conn is None:
+        conn = store.connect()
+    return conn
+
+# API key can be freely obtained from the EIA.
+def api_key():
+    try:
+        import api_key as key_file
+        return key_file.api_key
+    except ImportError:
+        pass
+    if "EIA_API_KEY" in os.environ:
+        return os.environ["EIA_API_KEY"]
+    raise RuntimeError("No EIA API key: create api_key.py or set EIA_API_KEY")
 
 # Same as the two letter postal codes
 state_codes = {
@@ -28,7 +58,7 @@ state_codes = {
     "Hawaii":"HI",
     "Idaho":"ID",
     "Illinois":"IL",
-    "Indiania":"IN",
+    "Indiana":"IN",
     "Iowa":"IA",
     "Kansas":"KS",
     "Kentucky":"KY",
@@ -68,119 +98,242 @@ state_codes = {
     "Wyoming":"WY"
 }    
 
-# Read a series from the EIA and store it in a table.
-def add_state_data(state, dataset, table):
-    series_name = "SEDS."+dataset+"."+state_codes[state]+".A"
-    series_data = requests.get("http://api.eia.gov/series/?api_key="+api_key.api_key+"&series_id="+series_name)
-    series_data = series_data.json()["series"][0]["data"]
-    for i in range(len(series_data)):
-        cur.execute("INSERT OR IGNORE INTO "+table+" (State, Year, Value) VALUES ('"+state+"',"+series_data[i][0]+", "+str(series_data[i][1])+");")
-    conn.commit()
+# SEDS series read for every state, as (dataset, table) pairs.
+state_series = [
+    ("TEEIB","electric_energy"),
+    ("TETXB","end_use_energy"), # Very similar to energy
+    ("ELISP","electricity_imports"),
+    ("GDPRX","gdp"),
+    ("TPOPP","population"),
+    ("ESTCD","electricity_price"), # Average electricity price across all sectors
+    ("TETCD","energy_price"), # Total average energy price
+    ("ESTCB","electricity"),
+    ("TETCB","energy"),
+    ("TEACB","transportation_energy"),
+    ("ESACB","transportation_electricity"),
+    ("TEICB","industrial_energy"),
+    ("ESICB","industrial_electricity"),
+    ("TECCB","commercial_energy"),
+    ("ESCCB","commercial_electricity"),
+    ("TERCB","residential_energy"),
+    ("ESRCB","residential_electricity")
+]
+
+# Tables filled with zeros for every state.
+zero_tables = ["electric_electricity"]
+
+# Read a series from the EIA and stage it for a table.
+# Pass series_data to store data that has already been fetched. Staged rows are written by write_staged_rows.
+def add_state_data(state, dataset, table, series_data=None):
+    if series_data is None:
+        with make_fetcher() as fetcher:
+            series_data = fetcher.fetch_series(fetch.seds_series_id(dataset, state_codes[state]))
+    staged_rows.setdefault(table, []).extend((state, int(year), value) for year, value in series_data)
     
 # Add some zeros, when they are needed for calculations.
 def add_state_zero(state,table):
-    series_data = [[str(year),"0"] for year in range(year_range[0],year_range[1])]
-    for i in range(len(series_data)):
-        cur.execute("INSERT OR IGNORE INTO "+table+" (State, Year, Value) VALUES ('"+state+"',"+series_data[i][0]+", "+str(series_data[i][1])+");")
-    conn.commit()
+    staged_rows.setdefault(table, []).extend((state, year, 0.0) for year in range(year_range[0],year_range[1]))
+
+# Write every staged batch with one parameterized executemany per table.
+# With upsert, existing values are replaced by revised ones instead of being ignored.
+# Each batch is validated first (see validate.py), with coverage checked across states when given; batches
+# for tables that are not registered series are reported and not written.
+# Returns the number of rows actually changed in each table.
+def write_staged_rows(upsert=False, states=None):
+    changes = {}
+    for table, rows in staged_rows.items():
+        if validate.check_rows(db(), table, rows, states=states):
+            changes[table] = store.write_rows(db(), table, rows, upsert)
+    staged_rows.clear()
+    return changes
+
+# Run a load as a single transaction, with durability relaxed until it commits.
+@contextmanager
+def bulk_load():
+    db().execute("PRAGMA journal_mode = WAL;")
+    db().execute("PRAGMA synchronous = OFF;")
+    db().execute("PRAGMA cache_size = -65536;") # 64 MB
+    try:
+        yield
+        db().commit()
+    except BaseException:
+        db().rollback()
+        raise
+    finally:
+        db().execute("PRAGMA synchronous = FULL;")
     
-# Add data in one table that is the quotient of two other data sets
-def add_quotient_data(numerator, denominator, table):
-    cur.execute("INSERT OR IGNORE INTO "+table+"(State, Year, Value) \
-        SELECT "+numerator+".State, "+numerator+".Year, "+numerator+".Value / "+denominator+".Value as Value \
-        FROM (\
-            SELECT * FROM "+numerator+" \
-        ) electricity \
-        JOIN ( \
-            SELECT * FROM "+denominator+" \
-        ) energy \
-        ON "+numerator+".State = "+denominator+".State AND "+numerator+".Year = "+denominator+".Year; \
-    ")
+# Per-series metadata used by refresh_tables to skip series that have not changed upstream.
+def make_series_meta_table():
+    db().execute("CREATE TABLE IF NOT EXISTS series_meta( \
+        SeriesId VARCHAR(64) PRIMARY KEY, \
+        TableName VARCHAR(64) NOT NULL, \
+        State VARCHAR(32) NOT NULL, \
+        Updated VARCHAR(32), \
+        LastYear int, \
+        ContentHash CHAR(64) \
+    );")
+    for old, new in store.renamed_states.items():
+        db().execute("UPDATE series_meta SET State = ? WHERE State = ?;", (new, old))
+
+def content_hash(series_data):
+    return hashlib.sha256(json.dumps(sorted(series_data), separators=(",", ":")).encode()).hexdigest()
+
+# With partial, series_data holds only the latest years, so the stored content hash is kept.
+def record_series_meta(series_id, table, state, updated, series_data, partial=False):
+    last_year = max((int(str(period)[:4]) for period, value in series_data), default=None)
+    db().execute("INSERT INTO series_meta (SeriesId, TableName, State, Updated, LastYear, ContentHash) VALUES (?, ?, ?, ?, ?, ?) \
+        ON CONFLICT (SeriesId) DO UPDATE SET TableName = excluded.TableName, State = excluded.State, Updated = excluded.Updated, \
+        LastYear = MAX(IFNULL(LastYear, excluded.LastYear), IFNULL(excluded.LastYear, LastYear)), \
+        ContentHash = IFNULL(excluded.ContentHash, ContentHash);",
+        (series_id, table, state, updated, last_year, None if partial else content_hash(series_data)))
+
+def read_series_meta():
+    rows = db().execute("SELECT SeriesId, Updated, LastYear, ContentHash FROM series_meta;").fetchall()
+    return {row[0]: {"updated": row[1], "last_year": row[2], "hash": row[3]} for row in rows}
     
 ######################################
 ######### Top Level Functions
 ######################################
 
-def make_single_table(table):
-    cur.execute("CREATE TABLE IF NOT EXISTS "+table+"( \
-        State VARCHAR(32) NOT NULL, \
-        Year int, \
-        Value FLOAT, \
-        UNIQUE (State, Year) \
-    );")
-    
+# All series share one fact table; see store.py. Old per-series tables are migrated into it.
 def create_tables():
-    make_single_table("electricity")
-    make_single_table("energy")
-    make_single_table("end_use_energy")
-    make_single_table("electrification")
-    make_single_table("electricity_price")
-    make_single_table("energy_price")
-    make_single_table("energy_price_share")
-    make_single_table("gdp")
-    make_single_table("population")
-    make_single_table("gdp_per_capita")
-    make_single_table("electricity_imports")
-    make_single_table("residential_energy")
-    make_single_table("residential_electricity")
-    make_single_table("residential_electrification")
-    make_single_table("commercial_energy")
-    make_single_table("commercial_electricity")
-    make_single_table("commercial_electrification")
-    make_single_table("industrial_energy")
-    make_single_table("industrial_electricity")
-    make_single_table("industrial_electrification")
-    make_single_table("transportation_energy")
-    make_single_table("transportation_electricity")
-    make_single_table("transportation_electrification")
-    make_single_table("electric_energy")
-    make_single_table("electric_electricity")
-    make_single_table("electric_electrification")
-    make_single_table("transportation_share")
-    make_single_table("industrial_share")
-    make_single_table("commercial_share")
-    make_single_table("residential_share")
-    make_single_table("electric_share")
+    store.create_schema(db())
+    make_series_meta_table()
+    rollup.create_tables(db())
+    db().commit()
     
-def build_tables():
+# Every downloaded series, as (state, dataset, table) triples.
+def state_jobs():
+    return [(state, dataset, table) for state in state_codes for dataset, table in state_series]
+
+def job_series_id(job):
+    state, dataset, table = job
+    return sources.sources["seds"].series_id(dataset, state_codes[state])
+
+# A fetcher backed by the response cache when use_cache is set.
+# offline serves everything from the cache; fresh skips cached responses but still stores new ones.
+# updates_url defaults to the updates endpoint next to base_url.
+def make_fetcher(concurrency=concurrency, base_url=fetch.base_url, offline=False, fresh=False, updates_url=None):
+    series_cache = None
+    if use_cache or offline:
+        series_cache = cache.SeriesCache(offline=offline)
+        if fresh and not offline:
+            series_cache.ttl = 0
+    return fetch.Fetcher("" if offline else api_key(), concurrency=concurrency, base_url=base_url, cache=series_cache, updates_url=updates_url)
+
+# Fetch every state series concurrently, then write them all once the fetches are done.
+# With offline, the database is built entirely from cached responses.
+@instrument.timed("build")
+def build_tables(concurrency=concurrency, base_url=fetch.base_url, offline=False):
+    jobs = state_jobs()
+    with make_fetcher(concurrency, base_url, offline) as fetcher:
+        results = fetcher.fetch_all([job_series_id(job) for job in jobs])
+    print("Fetched "+str(len(results))+" series") # Included to track progress
+
+    for job in jobs:
+        add_state_data(*job, series_data=results[job_series_id(job)]["data"])
     for state in state_codes:
-        print(state) # Included to track progress
-        add_state_data(state,"TEEIB","electric_energy")
-        add_state_zero(state,"electric_electricity")
-        add_state_data(state,"TETXB","end_use_energy") # Very similar to energy
-        add_state_data(state,"ELISP","electricity_imports")
-        add_state_data(state,"GDPRX","gdp")
-        add_state_data(state,"TPOPP","population")
-        add_state_data(state,"ESTCD","electricity_price") # Average electricity price across all sectors
-        add_state_data(state,"TETCD","energy_price") # Total average energy price
-        add_state_data(state,"ESTCB","electricity")
-        add_state_data(state,"TETCB","energy")
-        add_state_data(state,"TEACB","transportation_energy")
-        add_state_data(state,"ESACB","transportation_electricity")
-        add_state_data(state,"TEICB","industrial_energy")
-        add_state_data(state,"ESICB","industrial_electricity")
-        add_state_data(state,"TECCB","commercial_energy")
-        add_state_data(state,"ESCCB","commercial_electricity")
-        add_state_data(state,"TERCB","residential_energy")
-        add_state_data(state,"ESRCB","residential_electricity")
-
-    # Rate of electrification as percent of total energy
-    add_quotient_data("electricity", "energy", "electrification")
-    # Electricity price as share of energy price
-    add_quotient_data("electricity_price", "energy_price", "electricity_price_share")
-    add_quotient_data("gdp", "population", "gdp_per_capita")
-    add_quotient_data("residential_electricity", "residential_energy", "residential_electrification")
-    add_quotient_data("commercial_electricity", "commercial_energy", "commercial_electrification")
-    add_quotient_data("industrial_electricity", "industrial_energy", "industrial_electrification")
-    add_quotient_data("transportation_electricity", "transportation_energy", "transportation_electrification")
-    add_quotient_data("electric_electricity", "electric_energy", "electric_electrification") # Should all be zeroes
-    add_quotient_data("transportation_energy", "energy", "transportation_share")
-    add_quotient_data("industrial_energy", "energy", "industrial_share")
-    add_quotient_data("commercial_energy", "energy", "commercial_share")
-    add_quotient_data("residential_energy", "energy", "residential_share")
-    add_quotient_data("electric_energy", "energy", "electric_share")
-            
-    conn.commit()
+        for table in zero_tables:
+            add_state_zero(state, table)
+    count = sum(len(rows) for rows in staged_rows.values())
+
+    start = time.perf_counter()
+    with instrument.stage("write"), bulk_load():
+        write_staged_rows(states=state_codes)
+        add_derived_tables()
+        rollup.refresh(db())
+        for job in jobs:
+            info = results[job_series_id(job)]
+            record_series_meta(job_series_id(job), job[2], job[0], info.get("updated"), info["data"])
+    elapsed = time.perf_counter() - start
+    print("Wrote "+str(count)+" rows in "+format(elapsed, ".2f")+" s ("+format(count/max(elapsed, 1e-9), ",.0f")+" rows/s)")
+    print("Validation: "+validate.summary())
+
+# Bring an existing database up to date with as few requests as possible.
+# Only series whose last-updated stamp changed upstream are fetched, and revised values replace stored ones.
+# With tail_only, only years after the last stored year are requested. Offline, tail_only is ignored: the cache
+# only holds whole series, and their content hashes still skip the ones that did not change.
+# If the stamps cannot be read, every series is treated as stale.
+# Derived tables are recomputed only when their inputs changed.
+@instrument.timed("refresh")
+def refresh_tables(tail_only=False, concurrency=concurrency, base_url=fetch.base_url, offline=False, updates_url=None):
+    jobs = state_jobs()
+    meta = read_series_meta()
+    with make_fetcher(concurrency, base_url, offline, fresh=True, updates_url=updates_url) as fetcher:
+        try:
+            stamps = fetcher.fetch_updates()
+        except fetch.FetchError as e:
+            print("Could not read update stamps, checking every series: "+str(e))
+            stamps = None
+        stale = [job for job in jobs if stamps is None or job_series_id(job) not in meta
+            or stamps.get(job_series_id(job)) != meta[job_series_id(job)]["updated"]]
+        starts = {}
+        if tail_only and not offline:
+            for job in stale:
+                last_year = meta.get(job_series_id(job), {}).get("last_year")
+                if last_year is not None:
+                    starts[job_series_id(job)] = str(last_year+1)
+        results = fetcher.fetch_all([job_series_id(job) for job in stale], starts)
+    print("Fetched "+str(len(results))+" of "+str(len(jobs))+" series")
+
+    changed = set()
+    with instrument.stage("write"), bulk_load():
+        for job in stale:
+            series_id = job_series_id(job)
+            info = results[series_id]
+            partial = series_id in starts
+            if partial or content_hash(info["data"]) != meta.get(series_id, {}).get("hash"):
+                add_state_data(*job, series_data=info["data"])
+                if write_staged_rows(upsert=True).get(job[2]):
+                    changed.add(job[2])
+            record_series_meta(series_id, job[2], job[0], info.get("updated"), info["data"], partial)
+        for state in state_codes:
+            for table in zero_tables:
+                add_state_zero(state, table)
+        changed.update(table for table, count in write_staged_rows(states=state_codes).items() if count)
+        changed.update(add_derived_tables())
+        rollup.refresh(db())
+    print("Updated "+str(len(changed))+" tables")
+    print("Validation: "+validate.summary())
+
+# Load series of any source and frequency, e.g. load_source("grid_hourly", {"CISO": "CISO"}, [("D", "demand_hourly")]).
+# geographies maps names to the codes used in series ids and series lists (dataset, table) pairs.
+# Series are fetched and written batch series at a time, so memory stays flat however long the series are.
+# Revised values replace stored ones. Returns the number of rows changed.
+@instrument.timed("load_source")
+def load_source(source, geographies, series, concurrency=concurrency, base_url=fetch.base_url, offline=False, batch=64):
+    source = sources.sources[source] if isinstance(source, str) else source
+    for dataset, table in series:
+        store.add_series(db(), table, source.frequency)
+    db().commit()
+    jobs = source.jobs(geographies, series)
+    changed = 0
+    with make_fetcher(concurrency, base_url, offline) as fetcher:
+        for i in range(0, len(jobs), batch):
+            chunk = jobs[i:i+batch]
+            ids = [source.series_id(dataset, geographies[geography]) for geography, dataset, table in chunk]
+            results = fetcher.fetch_all(ids)
+            with instrument.stage("write"), bulk_load():
+                for (geography, dataset, table), series_id in zip(chunk, ids):
+                    info = results[series_id]
+                    periods = sources.parse_periods([period for period, value in info["data"]], source.frequency)
+                    rows = [(geography, int(period), value) for period, (label, value) in zip(periods, info["data"])]
+                    validate.check_rows(db(), table, rows, stage="load", coverage=source.frequency == "A")
+                    if source.frequency == "A":
+                        changed += store.write_rows(db(), table, rows, upsert=True, kind=source.kind)
+                    else:
+                        changed += store.write_period_rows(db(), table, rows, upsert=True, kind=source.kind)
+                    record_series_meta(series_id, table, geography, info.get("updated"), info["data"])
+    if source.frequency == "A":
+        with bulk_load():
+            rollup.refresh(db())
+    return changed
+
+# Tables computed from the downloaded data, as declared in derived.derived_series.
+# Only tables whose inputs changed since they were last computed are recalculated. Returns the tables that changed.
+def add_derived_tables(force=False):
+    return derived.evaluate(db(), force=force)
     
-create_tables()
-build_tables()
+if __name__ == "__main__":
+    create_tables()
+    build_tables()
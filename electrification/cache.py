@@ -0,0 +1,126 @@
+# On-disk cache of raw EIA series responses.
+# Payloads are stored content-addressed as objects/<sha256>.json, and an index maps each series key to its payload
+# along with fetch and access times, used for TTL expiry and least-recently-used eviction.
+# In offline mode entries never expire and misses are errors, so a database can be rebuilt without the API.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+cache_dir = "eia_cache"
+
+class CacheMiss(Exception):
+    pass
+
+class SeriesCache:
+    def __init__(self, path=cache_dir, ttl=7*24*3600, max_bytes=512*1024*1024, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(path, "index.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        self.conn.execute("PRAGMA synchronous = NORMAL;")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries( \
+            Key VARCHAR(96) PRIMARY KEY, \
+            Hash CHAR(64) NOT NULL, \
+            FetchedAt FLOAT NOT NULL, \
+            AccessedAt FLOAT NOT NULL \
+        );")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS objects( \
+            Hash CHAR(64) PRIMARY KEY, \
+            Size int NOT NULL \
+        );")
+        self.conn.commit()
+
+    def object_path(self, digest):
+        return os.path.join(self.path, "objects", digest+".json")
+
+    # The cached payload for a key, or None when it is missing or older than the TTL.
+    # In offline mode a missing key raises CacheMiss and the TTL is ignored.
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT Hash, FetchedAt FROM entries WHERE Key = ?;", (key,)).fetchone()
+            if row is None or not os.path.exists(self.object_path(row[0])):
+                if self.offline:
+                    raise CacheMiss("Not in cache: "+key)
+                return None
+            if not self.offline and self.ttl is not None and time.time() - row[1] > self.ttl:
+                return None
+            self.conn.execute("UPDATE entries SET AccessedAt = ? WHERE Key = ?;", (time.time(), key))
+            self.conn.commit()
+        with open(self.object_path(row[0]), "rb") as f:
+            return json.loads(f.read())
+
+    def put(self, key, payload):
+        body = json.dumps(payload, separators=(",", ":"), sort_keys=True).encode()
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            tmp = path+"."+str(threading.get_ident())+".tmp"
+            with open(tmp, "wb") as f:
+                f.write(body)
+            os.replace(tmp, path)
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO objects (Hash, Size) VALUES (?, ?);", (digest, len(body)))
+            self.conn.execute("INSERT INTO entries (Key, Hash, FetchedAt, AccessedAt) VALUES (?, ?, ?, ?) \
+                ON CONFLICT (Key) DO UPDATE SET Hash = excluded.Hash, FetchedAt = excluded.FetchedAt, AccessedAt = excluded.AccessedAt;",
+                (key, digest, now, now))
+            self.conn.commit()
+        self.evict()
+
+    # Total bytes of stored payloads.
+    def size(self):
+        with self.lock:
+            return self.conn.execute("SELECT IFNULL(SUM(Size), 0) FROM objects;").fetchone()[0]
+
+    # Drop least recently used entries until the cache fits in max_bytes, then delete unreferenced payloads.
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            total = self.conn.execute("SELECT IFNULL(SUM(Size), 0) FROM objects;").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            rows = self.conn.execute("SELECT entries.Key, entries.Hash, objects.Size FROM entries JOIN objects ON entries.Hash = objects.Hash \
+                ORDER BY entries.AccessedAt;").fetchall()
+            references = {}
+            for key, digest, size in rows:
+                references[digest] = references.get(digest, 0) + 1
+            for key, digest, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM entries WHERE Key = ?;", (key,))
+                references[digest] -= 1
+                if not references[digest]:
+                    total -= size
+            orphans = [row[0] for row in self.conn.execute("SELECT Hash FROM objects WHERE Hash NOT IN (SELECT Hash FROM entries);")]
+            self.conn.executemany("DELETE FROM objects WHERE Hash = ?;", [(digest,) for digest in orphans])
+            self.conn.commit()
+        for digest in orphans:
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    # Remove every entry and payload.
+    def clear(self):
+        with self.lock:
+            digests = [row[0] for row in self.conn.execute("SELECT Hash FROM objects;")]
+            self.conn.execute("DELETE FROM entries;")
+            self.conn.execute("DELETE FROM objects;")
+            self.conn.commit()
+        for digest in digests:
+            try:
+                os.remove(self.object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self.conn.close()
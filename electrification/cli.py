@@ -0,0 +1,197 @@
+# Command line entry point: python electrification <command>, or python -m electrification from the directory above.
+#   build       create the database and load every series from the EIA
+#   refresh     bring an existing database up to date
+#   load        load series of another source, e.g. load grid_hourly D:demand_hourly --geography CISO
+#   analyze     run named analyses from analysis.py
+#   plot        render figures (arguments as for plots.py)
+#   export      write series to Parquet or Arrow files
+#   validate    check the whole database and write a JSON report of the findings (see validate.py)
+#   serve       answer read-only queries over HTTP/JSON (see service.py)
+#   benchmark   time the pipeline on synthetic data (arguments as for benchmark.py)
+#   import-time time the import of each module in a fresh interpreter
+# Every command imports its module only when it runs, so the CLI itself starts without pandas, SciPy,
+# statsmodels, matplotlib or a database connection.
+# --report and --metrics turn on instrument.py for the command and write its run report as JSON or as
+# Prometheus text; --profile and --trace-memory add cProfile and tracemalloc captures per stage.
+# --validation writes the validation findings of build, refresh or load as JSON.
+
+import argparse
+import os
+import subprocess
+import sys
+import instrument
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Analysis name -> function in analysis.py. The default set is what analysis.py runs as a script.
+analyses = {
+    "price": "price_elec_regression",
+    "gdp": "gdp_elec_regression",
+    "energy": "energy_elec_regression",
+    "decomposition": "decomposition",
+    "decomposition-time": "decomposition_time",
+    "granger": "granger_causality",
+    "granger-states": "granger_causality_states",
+    "price-inference": "price_elec_inference",
+    "price-rolling": "price_elec_rolling"
+}
+default_analyses = ["price", "gdp", "decomposition", "decomposition-time"]
+
+modules = ["store", "cache", "fetch", "derived", "panel", "build_db", "analysis", "decompose", "regress", "granger", "plots", "export", "instrument", "sources", "resample", "rolling", "service", "validate", "rollup", "benchmark"]
+
+def build(args):
+    import build_db
+    build_db.create_tables()
+    build_db.build_tables(args.concurrency, args.base_url, args.offline)
+
+def refresh(args):
+    import build_db
+    build_db.create_tables()
+    build_db.refresh_tables(args.tail_only, args.concurrency, args.base_url, args.offline, args.updates_url)
+
+def load(args):
+    import build_db
+    build_db.create_tables()
+    geographies = dict(geography.split("=", 1) if "=" in geography else (geography, geography) for geography in args.geography)
+    series = [tuple(pair.split(":", 1)) for pair in args.series]
+    changed = build_db.load_source(args.source, geographies, series, args.concurrency, args.base_url, args.offline)
+    print("Changed "+str(changed)+" rows")
+
+def analyze(args):
+    unknown = [name for name in args.analyses if name not in analyses]
+    if unknown:
+        raise SystemExit("Unknown analyses: "+", ".join(unknown)+" (choose from "+", ".join(analyses)+")")
+    import analysis
+    for name in args.analyses or default_analyses:
+        with instrument.stage("analyze."+name):
+            result = getattr(analysis, analyses[name])()
+        if result is not None:
+            print(result)
+
+def plot(args):
+    import plots
+    plots.main(args.plot_args)
+
+def benchmark(args):
+    import benchmark
+    return benchmark.main(args.benchmark_args)
+
+# Exits with status 1 if any check found an error.
+def validate_db(args):
+    import store
+    import validate
+    conn = store.connect(args.database) if args.database else store.connect()
+    try:
+        result = validate.check_database(conn)
+    finally:
+        conn.close()
+    for check, total in sorted(result["totals"].items()):
+        print(check+"\t"+str(total["findings"])+" series\t"+str(total["cells"])+" cells")
+    print(validate.summary())
+    if args.out:
+        validate.write_report(args.out)
+    return 1 if result["errors"] else 0
+
+def serve(args):
+    import service
+    service.serve(args.database, args.host, args.port, args.connections)
+
+def export(args):
+    import export
+    written = export.export_series(args.series or None, outdir=args.out, format=args.format, force=args.force)
+    print("Exported "+str(len(written))+" series, "+str(sum(written.values()))+" rows")
+
+# Seconds to import one module in a fresh interpreter, so nothing is already loaded.
+def import_time(module):
+    code = "import time; start = time.perf_counter(); import "+module+"; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=here, capture_output=True, text=True, check=True).stdout
+    return float(output)
+
+def import_times(args):
+    for module in args.modules or modules:
+        print(module+"\t"+format(1000*import_time(module), ".1f")+" ms")
+
+def main(argv=None):
+    import fetch # Light: requests is only imported when a Fetcher is created
+    options = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    options.add_argument("--report", metavar="PATH", help="write a JSON run report of stage timings and counters")
+    options.add_argument("--metrics", metavar="PATH", help="write the run report in the Prometheus text format")
+    options.add_argument("--profile", action="store_true", help="profile each stage with cProfile (with --report)")
+    options.add_argument("--trace-memory", action="store_true", help="record peak memory of each stage (with --report)")
+    options.add_argument("--validation", metavar="PATH", help="write the validation findings of the command as JSON")
+    parser = argparse.ArgumentParser(prog="electrification", description="Build and analyze the electrification database.", parents=[options])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, run, help_text in [("build", build, "create the database from the EIA"), ("refresh", refresh, "update an existing database")]:
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("--offline", action="store_true", help="use cached EIA responses only")
+        command.add_argument("--concurrency", type=int, default=8, help="EIA requests in flight at once")
+        command.add_argument("--base-url", default=fetch.base_url, help="EIA series endpoint")
+        if name == "refresh":
+            command.add_argument("--updates-url", default=None, help="EIA updates endpoint (default: next to --base-url)")
+            command.add_argument("--tail-only", action="store_true", help="only request years after the last stored year")
+        command.set_defaults(run=run)
+
+    import sources
+    command = commands.add_parser("load", help="load series of another source")
+    command.add_argument("source", choices=list(sources.sources), help="source of the series")
+    command.add_argument("series", nargs="+", metavar="DATASET:TABLE", help="datasets to load and the series to store them as")
+    command.add_argument("--geography", action="append", required=True, metavar="NAME[=CODE]", help="geography to load, with its code in series ids")
+    command.add_argument("--offline", action="store_true", help="use cached EIA responses only")
+    command.add_argument("--concurrency", type=int, default=8, help="EIA requests in flight at once")
+    command.add_argument("--base-url", default=fetch.base_url, help="EIA series endpoint")
+    command.set_defaults(run=load)
+
+    command = commands.add_parser("analyze", help="run analyses")
+    command.add_argument("analyses", nargs="*", metavar="analysis", help="one or more of "+", ".join(analyses)+" (default: "+" ".join(default_analyses)+")")
+    command.set_defaults(run=analyze)
+
+    commands.add_parser("plot", help="render figures (see plot --help)")
+    commands.add_parser("benchmark", help="benchmark the pipeline (see benchmark --help)")
+
+    command = commands.add_parser("export", help="write series to columnar files")
+    command.add_argument("series", nargs="*", help="series to export (default: all)")
+    command.add_argument("--format", choices=["parquet", "arrow"], default="parquet", help="file format")
+    command.add_argument("--out", default="eia_export", help="output directory")
+    command.add_argument("--force", action="store_true", help="export even if the series has not changed")
+    command.set_defaults(run=export)
+
+    command = commands.add_parser("validate", help="check the database for bad or missing data")
+    command.add_argument("--database", default=None, help="database to check (default: eia.db)")
+    command.add_argument("--out", metavar="PATH", help="write the findings as JSON")
+    command.set_defaults(run=validate_db)
+
+    command = commands.add_parser("serve", help="serve read-only queries over HTTP")
+    command.add_argument("--database", default=None, help="database to serve (default: eia.db)")
+    command.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    command.add_argument("--port", type=int, default=8000, help="port to listen on")
+    command.add_argument("--connections", type=int, default=8, help="read-only database connections")
+    command.set_defaults(run=serve)
+
+    command = commands.add_parser("import-time", help="time module imports")
+    command.add_argument("modules", nargs="*", help="modules to time (default: all)")
+    command.set_defaults(run=import_times)
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    instrumentation, argv = options.parse_known_args(argv)
+    if argv[:1] == ["plot"]: # plots.py and benchmark.py parse their own options
+        args = argparse.Namespace(run=plot, plot_args=argv[1:])
+    elif argv[:1] == ["benchmark"]:
+        args = argparse.Namespace(run=benchmark, benchmark_args=argv[1:])
+    else:
+        args = parser.parse_args(argv)
+    if instrumentation.report or instrumentation.metrics:
+        instrument.enable(instrumentation.profile, instrumentation.trace_memory)
+    try:
+        return args.run(args)
+    finally:
+        if instrumentation.report:
+            instrument.write_report(instrumentation.report)
+        if instrumentation.metrics:
+            instrument.write_prometheus(instrumentation.metrics)
+        if instrumentation.validation:
+            import validate
+            validate.write_report(instrumentation.validation)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# Shift-share decomposition of electrification into change within sectors and change between sectors.
+# Electrification is the sum over sectors of the sector's share of energy times its electrification rate.
+# Both modes work on whole (sector, state, year) arrays from the panel, so every state and year is done at once:
+#   time: for pairs of years, split the change in electrification into the part from changing sector rates
+#         (within) and the part from changing sector shares (between), using averaged weights.
+#   states: for each year, split the variance across states into the part from differing rates within
+#           sectors and the part from differing sector shares, against a reference state's shares and rates.
+
+import numpy as np
+import pandas as pd
+import instrument
+from panel import load_panel, us
+
+sectors = ["residential", "commercial", "industrial", "transportation"]
+
+def sector_series():
+    return ["electrification"]+[sector+suffix for suffix in ["_share", "_electricity", "_energy"] for sector in sectors]
+
+# (sector, state, year) arrays of sector shares of energy and sector electrification rates.
+def shares_and_rates(panel):
+    shares = np.stack([panel.get(sector+"_share") for sector in sectors])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = np.stack([panel.get(sector+"_electricity")/panel.get(sector+"_energy") for sector in sectors])
+    return shares, rates
+
+# Year pairs to decompose: consecutive years, or every pair with the first year before the second.
+def year_pairs(years, start=None, end=None, pairs="consecutive"):
+    years = [year for year in years if (start is None or year >= start) and (end is None or year <= end)]
+    if pairs == "consecutive":
+        return list(zip(years[:-1], years[1:]))
+    if pairs == "all":
+        return [(a, b) for i, a in enumerate(years) for b in years[i+1:]]
+    raise ValueError("Unknown year pairs: "+str(pairs))
+
+# Within and between sector change for every state and year pair, as a tidy DataFrame with one row per
+# (State, StartYear, EndYear). WithinShare is the fraction of the total change due to rates within sectors.
+@instrument.timed("decompose")
+def decompose_time(panel=None, start=None, end=None, pairs="consecutive", states=None):
+    panel = panel or load_panel(sector_series())
+    shares, rates = shares_and_rates(panel)
+    pair_list = year_pairs([int(year) for year in panel.years], start, end, pairs)
+    state_list = list(states) if states is not None else panel.states
+    rows = [panel.state_index[state] for state in state_list]
+    i0 = np.array([panel.year_index(a) for a, b in pair_list], dtype=int)
+    i1 = np.array([panel.year_index(b) for a, b in pair_list], dtype=int)
+    s0, s1 = shares[:, rows][:, :, i0], shares[:, rows][:, :, i1]
+    e0, e1 = rates[:, rows][:, :, i0], rates[:, rows][:, :, i1]
+    within = ((s0 + s1) / 2 * (e1 - e0)).sum(axis=0)
+    between = ((e0 + e1) / 2 * (s1 - s0)).sum(axis=0)
+    total = within + between
+    with np.errstate(divide="ignore", invalid="ignore"):
+        within_share = within / total
+    return pd.DataFrame({
+        "State": np.repeat(state_list, len(pair_list)),
+        "StartYear": np.tile([a for a, b in pair_list], len(state_list)),
+        "EndYear": np.tile([b for a, b in pair_list], len(state_list)),
+        "Total": total.ravel(),
+        "Within": within.ravel(),
+        "Between": between.ravel(),
+        "WithinShare": within_share.ravel()
+    })
+
+# Cross-state variance decomposition for each year, as a tidy DataFrame with one row per Year.
+# ConstantShares applies the reference state's shares to every state's rates, ConstantRates the reverse.
+@instrument.timed("decompose")
+def decompose_states(panel=None, years=None, reference=us, exclude=(us,)):
+    panel = panel or load_panel(sector_series())
+    shares, rates = shares_and_rates(panel)
+    rows = [i for i, state in enumerate(panel.states) if state not in exclude]
+    columns = [panel.year_index(year) for year in years] if years is not None else list(range(len(panel.years)))
+    ref = panel.state_index[reference]
+    s, e = shares[:, rows][:, :, columns], rates[:, rows][:, :, columns]
+    s_ref, e_ref = shares[:, ref, columns][:, None, :], rates[:, ref, columns][:, None, :]
+    constant_shares = np.nanvar((s_ref * e).sum(axis=0), axis=0)
+    constant_rates = np.nanvar((s * e_ref).sum(axis=0), axis=0)
+    overall = np.nanvar(panel.get("electrification")[rows][:, columns], axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        within_share = (constant_shares + (overall - constant_rates)) / 2.0 / overall
+    return pd.DataFrame({
+        "Year": panel.years[columns],
+        "Variance": overall,
+        "ConstantShares": constant_shares,
+        "ConstantRates": constant_rates,
+        "WithinShare": within_share,
+        "BetweenShare": 1 - within_share
+    })
+
+# Run either mode of the decomposition; keyword arguments go to decompose_time or decompose_states.
+def decompose(mode="time", panel=None, **kwargs):
+    if mode == "time":
+        return decompose_time(panel, **kwargs)
+    if mode == "states":
+        return decompose_states(panel, **kwargs)
+    raise ValueError("Unknown decomposition mode: "+str(mode))
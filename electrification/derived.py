@@ -0,0 +1,172 @@
+# Derived series, declared as operations on other series and evaluated as a dependency graph.
+# Inputs are loaded once into a series x state x year matrix. Nodes at the same depth that share an operation are
+# computed together as one stacked array operation, and only cells that changed are written back.
+# A node is recomputed only when the versions of its inputs differ from those it was last computed from.
+
+import json
+import numpy as np
+import instrument
+import store
+import validate
+
+# Name: (operation, inputs). Inputs may be downloaded series or other derived series.
+#   ratio: a / b    difference: a - b    sum: a + b + ...    growth: year over year growth of a
+derived_series = {
+    "electrification": ("ratio", ["electricity", "energy"]), # Rate of electrification as percent of total energy
+    "electricity_price_share": ("ratio", ["electricity_price", "energy_price"]), # Electricity price as share of energy price
+    "gdp_per_capita": ("ratio", ["gdp", "population"]),
+    "residential_electrification": ("ratio", ["residential_electricity", "residential_energy"]),
+    "commercial_electrification": ("ratio", ["commercial_electricity", "commercial_energy"]),
+    "industrial_electrification": ("ratio", ["industrial_electricity", "industrial_energy"]),
+    "transportation_electrification": ("ratio", ["transportation_electricity", "transportation_energy"]),
+    "electric_electrification": ("ratio", ["electric_electricity", "electric_energy"]), # Should all be zeroes
+    "transportation_share": ("ratio", ["transportation_energy", "energy"]),
+    "industrial_share": ("ratio", ["industrial_energy", "energy"]),
+    "commercial_share": ("ratio", ["commercial_energy", "energy"]),
+    "residential_share": ("ratio", ["residential_energy", "energy"]),
+    "electric_share": ("ratio", ["electric_energy", "energy"])
+}
+
+def growth(a):
+    out = np.full(a.shape, np.nan)
+    out[..., 1:] = (a[..., 1:] - a[..., :-1]) / a[..., :-1]
+    return out
+
+# Each operation works on stacked (node, state, year) arrays, one argument per input.
+operations = {
+    "ratio": lambda a, b: a / b,
+    "difference": lambda a, b: a - b,
+    "sum": lambda *inputs: sum(inputs),
+    "growth": growth
+}
+
+def growth_mask(present):
+    out = np.zeros(present.shape, bool)
+    out[..., 1:] = present[..., 1:] & present[..., :-1]
+    return out
+
+# Derived nodes grouped by depth, so that every node only depends on nodes in earlier groups.
+def dependency_levels(specs=derived_series):
+    depth = {}
+    def visit(name, path):
+        if name not in specs:
+            return -1
+        if name in path:
+            raise ValueError("Cycle in derived series: "+" -> ".join(path+[name]))
+        if name not in depth:
+            op, inputs = specs[name]
+            if op not in operations:
+                raise ValueError("Unknown operation for "+name+": "+op)
+            depth[name] = 1 + max(visit(source, path+[name]) for source in inputs)
+        return depth[name]
+    for name in specs:
+        visit(name, [])
+    levels = [[] for i in range(max(depth.values(), default=-1)+1)]
+    for name in specs:
+        levels[depth[name]].append(name)
+    return levels
+
+# Values and presence of the named series as (series, state, year) arrays over every state id and year.
+# NULL values are NaN but still present.
+def load_matrix(conn, names):
+    ids = [store.series_id(conn, name) for name in names]
+    rows = conn.execute("SELECT SeriesId, StateId, Year, Value FROM observations WHERE SeriesId IN ("+", ".join("?"*len(ids))+");", ids).fetchall()
+    instrument.count("queries")
+    instrument.count("rows_read", len(rows))
+    state_ids = np.array([row[0] for row in conn.execute("SELECT StateId FROM states WHERE Kind = 'state' \
+        OR StateId IN (SELECT DISTINCT StateId FROM observations WHERE SeriesId IN ("+", ".join("?"*len(ids))+")) ORDER BY StateId;", ids)], dtype=int)
+    data = np.array(rows, dtype=float).reshape(-1, 4)
+    years = np.arange(int(data[:, 2].min()), int(data[:, 2].max())+1) if len(data) else np.arange(0)
+    values = np.full((len(names), len(state_ids), len(years)), np.nan)
+    present = np.zeros(values.shape, bool)
+    if len(data):
+        series_index = np.zeros(max(ids)+1, int)
+        series_index[ids] = np.arange(len(ids))
+        state_index = np.zeros(state_ids.max()+1, int)
+        state_index[state_ids] = np.arange(len(state_ids))
+        cell = (series_index[data[:, 0].astype(int)], state_index[data[:, 1].astype(int)], data[:, 2].astype(int) - years[0])
+        values[cell] = data[:, 3]
+        present[cell] = True
+    return values, present, state_ids, years
+
+# Every stale derived node, plus everything downstream of one.
+def stale_nodes(conn, specs, force=False):
+    versions = store.series_versions(conn)
+    recorded = {name: inputs for name, inputs in conn.execute("SELECT Name, InputVersions FROM series;")}
+    stale = set()
+    for level in dependency_levels(specs):
+        for name in level:
+            op, inputs = specs[name]
+            if force or recorded.get(name) != input_versions(inputs, versions) or stale.intersection(inputs):
+                stale.add(name)
+    return stale
+
+def input_versions(inputs, versions):
+    return json.dumps([versions.get(source, 0) for source in inputs])
+
+# Recompute stale derived series and write the cells that changed. Returns the names of series whose data changed.
+# Nodes with an input that is not a registered series are reported by validate.check_specs and skipped, along with
+# everything downstream of them. Zero denominators and out-of-range results are reported as they are computed.
+@instrument.timed("derive")
+def evaluate(conn, specs=derived_series, force=False):
+    for name in specs:
+        store.add_series(conn, name)
+    skipped = set(validate.check_specs(conn, specs))
+    while True:
+        downstream = {name for name, (op, inputs) in specs.items() if name not in skipped and skipped.intersection(inputs)}
+        if not downstream:
+            break
+        skipped |= downstream
+    specs = {name: spec for name, spec in specs.items() if name not in skipped}
+    stale = stale_nodes(conn, specs, force)
+    if not stale:
+        return []
+    names = sorted(stale.union(*(specs[name][1] for name in stale)))
+    values, present, state_ids, years = load_matrix(conn, names)
+    state_names = dict(conn.execute("SELECT StateId, Name FROM states;").fetchall())
+    labels = [state_names[int(state)] for state in state_ids]
+    index = {name: i for i, name in enumerate(names)}
+    current_values, current_present = values.copy(), present.copy()
+
+    for level in dependency_levels(specs):
+        groups = {}
+        for name in level:
+            if name in stale:
+                op, inputs = specs[name]
+                groups.setdefault((op, len(inputs)), []).append(name)
+        for (op, arity), group in groups.items():
+            rows = [index[name] for name in group]
+            columns = [[index[specs[name][1][k]] for name in group] for k in range(arity)]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result = operations[op](*(values[column] for column in columns))
+            mask = np.logical_and.reduce([present[column] for column in columns])
+            if op == "growth":
+                mask = growth_mask(mask)
+            if op == "ratio":
+                for k, name in enumerate(group):
+                    validate.check_denominator(name, values[columns[1][k]], mask[k], labels, years, "derive")
+            result[~np.isfinite(result)] = np.nan # Division by zero is stored as NULL
+            values[rows] = np.where(mask, result, np.nan)
+            present[rows] = mask
+            for k, name in enumerate(group):
+                validate.check_values(name, values[rows[k]], labels, years, "derive")
+
+    changed = []
+    versions = store.series_versions(conn)
+    for name in [name for level in dependency_levels(specs) for name in level if name in stale]:
+        i = index[name]
+        series = store.series_id(conn, name)
+        same = (values[i] == current_values[i]) | (np.isnan(values[i]) & np.isnan(current_values[i]))
+        write = present[i] & ~(current_present[i] & same)
+        remove = current_present[i] & ~present[i]
+        states, cols = np.nonzero(write)
+        rows = [(series, int(state_ids[s]), int(years[c]), None if np.isnan(v) else float(v))
+            for s, c, v in zip(states, cols, values[i][write])]
+        count = store.write_id_rows(conn, series, rows, upsert=True)
+        states, cols = np.nonzero(remove)
+        count += store.delete_cells(conn, series, [(int(state_ids[s]), int(years[c])) for s, c in zip(states, cols)])
+        if count:
+            changed.append(name)
+            versions = store.series_versions(conn)
+        conn.execute("UPDATE series SET InputVersions = ? WHERE SeriesId = ?;", (input_versions(specs[name][1], versions), series))
+    return changed
@@ -0,0 +1,168 @@
+# Export of base and derived series to columnar files for use outside sqlite.
+# Each series is streamed out of the observations table in chunks, one Parquet row group or Arrow record batch
+# per chunk, into its own partition directory: <outdir>/series=<name>/data.parquet or data.arrow, with columns
+# StateId, Year and Value. states.parquet / states.arrow map StateId to Name and Kind. Memory use depends on the chunk size,
+# not on the number of series. manifest.json records the version each series was exported at, so unchanged
+# series are skipped on the next export.
+# read_panel builds a Panel from the Arrow files through memory maps, without opening the database.
+# pyarrow is only needed here and is imported when an export or read runs.
+
+import os
+import tempfile
+import numpy as np
+import instrument
+import store
+from panel import Panel
+
+export_dir = "eia_export"
+manifest_name = "manifest.json"
+chunk_rows = 65536 # Rows per row group or record batch
+formats = {"parquet": "data.parquet", "arrow": "data.arrow"}
+
+def partition_dir(outdir, name):
+    return os.path.join(outdir, "series="+name)
+
+def observation_schema():
+    import pyarrow as pa
+    return pa.schema([("StateId", pa.int32()), ("Year", pa.int32()), ("Value", pa.float64())])
+
+# Writer for one output file. Parquet keeps missing values as nulls; Arrow files store them as NaN so that
+# read_panel can view the Value buffers without a copy.
+class ChunkWriter:
+    def __init__(self, path, schema, format):
+        import pyarrow as pa
+        self.pa = pa
+        self.format = format
+        if format == "parquet":
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, schema, compression="zstd")
+        else:
+            self.sink = pa.OSFile(path, "wb")
+            self.writer = pa.ipc.new_file(self.sink, schema)
+
+    def write(self, columns, schema):
+        arrays = []
+        for field, values in zip(schema, columns):
+            mask = np.isnan(values) if self.format == "parquet" and field.type == self.pa.float64() else None
+            arrays.append(self.pa.array(values, type=field.type, mask=mask))
+        self.writer.write_batch(self.pa.record_batch(arrays, schema=schema))
+
+    def close(self):
+        self.writer.close()
+        if self.format != "parquet":
+            self.sink.close()
+
+# Stream one series into path, chunk_rows rows at a time. Returns the row count and the first and last year.
+def write_series(conn, name, path, format="parquet", chunk_rows=chunk_rows):
+    schema = observation_schema()
+    cursor = conn.execute("SELECT StateId, Year, Value FROM observations WHERE SeriesId = ? ORDER BY StateId, Year;", [store.series_id(conn, name)])
+    instrument.count("queries")
+    writer = ChunkWriter(path, schema, format)
+    count, first, last = 0, None, None
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            data = np.array(rows, dtype=float).reshape(-1, 3)
+            writer.write([data[:, 0].astype(np.int32), data[:, 1].astype(np.int32), data[:, 2]], schema)
+            instrument.count("rows_read", len(data))
+            count += len(data)
+            first = int(data[:, 1].min()) if first is None else min(first, int(data[:, 1].min()))
+            last = int(data[:, 1].max()) if last is None else max(last, int(data[:, 1].max()))
+    finally:
+        writer.close()
+    return count, first, last
+
+def write_states(conn, outdir, format):
+    import pyarrow as pa
+    rows = conn.execute("SELECT StateId, Name, Kind FROM states ORDER BY StateId;").fetchall()
+    table = pa.table({
+        "StateId": pa.array([row[0] for row in rows], pa.int32()),
+        "Name": pa.array([row[1] for row in rows], pa.string()),
+        "Kind": pa.array([row[2] for row in rows], pa.string())
+    })
+    path = os.path.join(outdir, "states."+format)
+    handle, tmp = tempfile.mkstemp(dir=outdir, prefix=".states.")
+    os.close(handle)
+    if format == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(table, tmp)
+    else:
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp, path)
+
+# Export the named series, or every series, from the database at path into outdir.
+# format is "parquet" or "arrow". Series whose version has not changed since the last export are skipped unless
+# force is set. Returns {series name: rows written} for the series that were exported.
+@instrument.timed("export")
+def export_series(names=None, path=store.db_path, outdir=export_dir, format="parquet", chunk_rows=chunk_rows, force=False):
+    if format not in formats:
+        raise ValueError("Unknown export format: "+str(format))
+    os.makedirs(outdir, exist_ok=True)
+    manifest = store.read_manifest(os.path.join(outdir, manifest_name), {"series": {}})
+    conn = store.connect(path)
+    written = {}
+    try:
+        store.upgrade(conn)
+        versions = store.series_versions(conn)
+        names = list(names) if names is not None else [row[0] for row in conn.execute("SELECT Name FROM series WHERE Frequency = 'A';")]
+        unknown = [name for name in names if name not in versions]
+        if unknown:
+            raise KeyError("Unknown series: "+", ".join(unknown))
+        write_states(conn, outdir, format)
+        for name in names:
+            entry = manifest["series"].get(name, {}).get(format)
+            output = os.path.join(partition_dir(outdir, name), formats[format])
+            if not force and entry is not None and entry["version"] == versions[name] and os.path.exists(output):
+                continue
+            os.makedirs(partition_dir(outdir, name), exist_ok=True)
+            handle, tmp = tempfile.mkstemp(dir=partition_dir(outdir, name), prefix=".data.")
+            os.close(handle)
+            try:
+                count, first, last = write_series(conn, name, tmp, format, chunk_rows)
+                os.replace(tmp, output)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            manifest["series"].setdefault(name, {})[format] = {"version": versions[name], "rows": count, "first_year": first, "last_year": last}
+            written[name] = count
+    finally:
+        conn.close()
+    store.write_manifest(os.path.join(outdir, manifest_name), manifest)
+    return written
+
+# Panel of the named series, or of every exported series, read from the Arrow files in outdir.
+# The files are memory mapped and each record batch is viewed as NumPy arrays in place; the only copy is the
+# scatter into the panel's (series, state, year) array. Gives the same Panel as panel.load_panel: states, plus
+# other geographies such as balancing authorities only if they have data in the named series.
+def read_panel(names=None, outdir=export_dir):
+    import pyarrow as pa
+    manifest = store.read_manifest(os.path.join(outdir, manifest_name), {"series": {}})
+    exported = {name: entry["arrow"] for name, entry in manifest["series"].items() if "arrow" in entry}
+    names = list(names) if names is not None else sorted(exported)
+    missing = [name for name in names if name not in exported]
+    if missing:
+        raise KeyError("Not exported as Arrow: "+", ".join(missing))
+    with pa.memory_map(os.path.join(outdir, "states.arrow")) as source:
+        states = pa.ipc.open_file(source).read_all()
+        state_ids = states.column("StateId").to_numpy()
+        state_names = states.column("Name").to_pylist()
+        kinds = states.column("Kind").to_pylist() if "Kind" in states.column_names else ["state"]*len(state_names) # Older exports
+    spans = [(exported[name]["first_year"], exported[name]["last_year"]) for name in names if exported[name]["rows"]]
+    years = np.arange(min(a for a, b in spans), max(b for a, b in spans)+1) if spans else np.arange(0)
+    values = np.full((len(names), len(state_ids), len(years)), np.nan)
+    state_index = np.zeros(state_ids.max()+1 if len(state_ids) else 0, int)
+    state_index[state_ids] = np.arange(len(state_ids))
+    keep = np.array([kind == "state" for kind in kinds], dtype=bool)
+    for i, name in enumerate(names):
+        with pa.memory_map(os.path.join(partition_dir(outdir, name), formats["arrow"])) as source:
+            reader = pa.ipc.open_file(source)
+            for k in range(reader.num_record_batches):
+                batch = reader.get_batch(k)
+                rows = state_index[batch.column(0).to_numpy()]
+                keep[rows] = True
+                columns = batch.column(1).to_numpy() - years[0]
+                values[i, rows, columns] = batch.column(2).to_numpy()
+    return Panel(values[:, keep], names, [state for state, kept in zip(state_names, keep) if kept], years)
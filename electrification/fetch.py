@@ -0,0 +1,162 @@
+# Fetch layer for the EIA API.
+# Requests share one pooled session and run a bounded number at a time, with per-host rate limiting
+# and retry with exponential backoff. Point base_url at a local stand-in server for testing.
+# Given a cache.SeriesCache, series responses are served from disk when possible.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import cache
+import instrument
+
+base_url = "http://api.eia.gov/series/"
+seds_category = 40236 # State Energy Data System
+retry_statuses = (429, 500, 502, 503, 504)
+
+# Updates endpoint next to a series endpoint, so a local stand-in for one serves both.
+def updates_url_for(series_url):
+    return urljoin(series_url, "../updates/")
+
+# Name of a state-level annual SEDS series, e.g. SEDS.TETCB.CA.A
+def seds_series_id(dataset, state_code):
+    return "SEDS."+dataset+"."+state_code+".A"
+
+# Spaces out requests to the same host so that no more than `rate` start per second.
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0/rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, host):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class FetchError(Exception):
+    pass
+
+# A request for error messages: the URL without its query string, and the series or category asked for.
+# Never the api_key.
+def describe(url, params):
+    parts = urlsplit(url)
+    what = params.get("series_id") or params.get("category_id")
+    return parts.scheme+"://"+parts.netloc+parts.path+("" if what is None else " ("+str(what)+")")
+
+class Fetcher:
+    def __init__(self, api_key, concurrency=8, rate=20, retries=4, backoff=0.5, timeout=30, base_url=base_url, cache=None, updates_url=None):
+        self.api_key = api_key
+        self.cache = cache
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.base_url = base_url
+        self.updates_url = updates_url or updates_url_for(base_url)
+        self.limiter = RateLimiter(rate)
+        import requests # Imported here so that importing this module stays cheap
+        from requests.adapters import HTTPAdapter
+        self.requests = requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    # GET a JSON document, retrying connection errors and retryable statuses with exponential backoff.
+    def get_json(self, params, url=None):
+        url = url or self.base_url
+        host = urlsplit(url).netloc
+        params = dict(params, api_key=self.api_key)
+        for attempt in range(self.retries+1):
+            self.limiter.wait(host)
+            delay = self.backoff * 2**attempt
+            instrument.count("requests")
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (self.requests.ConnectionError, self.requests.Timeout) as e:
+                if attempt == self.retries:
+                    # The exception text holds the full URL, api_key included, so only its type is reported
+                    raise FetchError(type(e).__name__+" for "+describe(url, params)) from None
+                instrument.count("retries")
+                time.sleep(delay)
+                continue
+            instrument.count("bytes_fetched", len(response.content))
+            if response.status_code in retry_statuses and attempt < self.retries:
+                instrument.count("retries")
+                retry_after = response.headers.get("Retry-After", "")
+                time.sleep(float(retry_after) if retry_after.isdigit() else delay)
+                continue
+            if response.status_code != 200:
+                raise FetchError("HTTP "+str(response.status_code)+" for "+describe(url, params))
+            return response.json()
+
+    # One series as returned by the API: a dict with "data" as a list of [period, value] pairs,
+    # plus metadata such as "updated". Pass start to fetch only periods from start onward.
+    def fetch_series_info(self, series_id, start=None):
+        key = series_id if start is None else series_id+"@"+str(start)
+        if self.cache is not None:
+            try:
+                info = self.cache.get(key)
+            except cache.CacheMiss as e:
+                raise FetchError(str(e)) from e
+            if info is not None:
+                instrument.count("cache_hits")
+                return info
+        params = {"series_id": series_id}
+        if start is not None:
+            params["start"] = start
+        payload = self.get_json(params)
+        if "series" not in payload:
+            raise FetchError("No data for "+series_id+": "+str(payload.get("data", payload)))
+        info = payload["series"][0]
+        if self.cache is not None:
+            self.cache.put(key, info)
+        return info
+
+    # Data points of one series as a list of [period, value] pairs.
+    def fetch_series(self, series_id, start=None):
+        return self.fetch_series_info(series_id, start)["data"]
+
+    # Fetch many series concurrently. Returns a dict of series id to series info once all are done.
+    # starts optionally maps a series id to the first period to fetch.
+    @instrument.timed("fetch")
+    def fetch_all(self, series_ids, starts=None):
+        series_ids = list(dict.fromkeys(series_ids))
+        starts = starts or {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            results = pool.map(lambda series_id: self.fetch_series_info(series_id, starts.get(series_id)), series_ids)
+            return dict(zip(series_ids, results))
+
+    # Last-updated stamps for every series in a category, as a dict of series id to stamp.
+    # Not available offline.
+    def fetch_updates(self, category_id=seds_category, rows=10000):
+        if self.cache is not None and self.cache.offline:
+            raise FetchError("Update stamps are not available offline")
+        stamps = {}
+        first_row = 0
+        while True:
+            payload = self.get_json({"category_id": category_id, "deep": "true", "rows": rows, "firstrow": first_row}, url=self.updates_url)
+            page = payload.get("updates", payload.get("data", []))
+            for entry in page:
+                stamps[entry["series_id"]] = entry["updated"]
+            if len(page) < rows:
+                return stamps
+            first_row += rows
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
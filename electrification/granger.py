@@ -0,0 +1,118 @@
+# Granger causality sweeps across states and pairs of series.
+# For each state and (dependent, cause) pair the series are differenced and a lag matrix is built once up to
+# maxlag; the restricted and unrestricted regressions for every lag reuse slices of it. States run in parallel
+# across a process pool and the results are written to the granger_results table.
+# The tests match statsmodels' grangercausalitytests, which checks whether the second column causes the first.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import stats
+import instrument
+import store
+from panel import load_panel
+
+maxlag = 15 # Maximum number of years to test for a lag
+
+# (dependent, cause) pairs tested by default.
+granger_pairs = [
+    ("electrification", "electricity_price_share"),
+    ("electricity_price_share", "electrification")
+]
+
+# (rows, maxlag) matrix whose column k-1 holds the series lagged by k years.
+def lag_matrix(values, maxlag):
+    lags = np.full((len(values), maxlag), np.nan)
+    for k in range(1, maxlag+1):
+        lags[k:, k-1] = values[:-k]
+    return lags
+
+def ssr(design, target):
+    coefs, residuals, rank, sv = np.linalg.lstsq(design, target, rcond=None)
+    resid = target - design @ coefs
+    return resid @ resid
+
+# Granger tests of whether cause helps predict dependent, for every lag from 1 to maxlag.
+# Returns a list of dicts with the F and chi-squared statistics and p-values for each lag.
+def granger_tests(dependent, cause, maxlag=maxlag, diff=True):
+    data = np.column_stack([dependent, cause]).astype(float)
+    if diff:
+        data = np.diff(data, axis=0)
+    data = data[np.isfinite(data).all(axis=1)]
+    y, x = data[:, 0], data[:, 1]
+    lags_y, lags_x = lag_matrix(y, maxlag), lag_matrix(x, maxlag)
+    results = []
+    for lag in range(1, maxlag+1):
+        nobs = len(y) - lag
+        df_resid = nobs - 2*lag - 1
+        result = {"Lag": lag, "Nobs": nobs, "F": np.nan, "FP": np.nan, "Chi2": np.nan, "Chi2P": np.nan}
+        if df_resid > 0:
+            constant = np.ones((nobs, 1))
+            restricted = np.hstack([lags_y[lag:, :lag], constant])
+            unrestricted = np.hstack([lags_y[lag:, :lag], lags_x[lag:, :lag], constant])
+            ssr_r, ssr_u = ssr(restricted, y[lag:]), ssr(unrestricted, y[lag:])
+            f = (ssr_r - ssr_u) / ssr_u / lag * df_resid
+            chi2 = nobs * (ssr_r - ssr_u) / ssr_u
+            result.update({"F": f, "FP": stats.f.sf(f, lag, df_resid), "Chi2": chi2, "Chi2P": stats.chi2.sf(chi2, lag)})
+        results.append(result)
+    return results
+
+# Every pair for one state. series maps names to that state's values by year.
+def state_tests(state, series, pairs, maxlag, diff):
+    rows = []
+    for dependent, cause in pairs:
+        for result in granger_tests(series[dependent], series[cause], maxlag, diff):
+            rows.append(dict(result, State=state, Dependent=dependent, Cause=cause))
+    return rows
+
+# NumPy scalars as plain Python values, with NaN as NULL.
+def sql_value(value):
+    if pd.isna(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+def make_results_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS granger_results( \
+        State VARCHAR(32) NOT NULL, \
+        Dependent VARCHAR(64) NOT NULL, \
+        Cause VARCHAR(64) NOT NULL, \
+        Lag int NOT NULL, \
+        Nobs int, \
+        F FLOAT, \
+        FP FLOAT, \
+        Chi2 FLOAT, \
+        Chi2P FLOAT, \
+        PRIMARY KEY (State, Dependent, Cause, Lag) \
+    );")
+
+# Run Granger tests for every state (and the US aggregate) and every pair across a process pool.
+# Results are returned as a DataFrame and, unless write is False, stored in granger_results.
+@instrument.timed("granger")
+def granger_sweep(pairs=granger_pairs, states=None, maxlag=maxlag, diff=True, processes=None, write=True, path=store.db_path):
+    names = list(dict.fromkeys(name for pair in pairs for name in pair))
+    panel = load_panel(names, path)
+    states = list(states) if states is not None else panel.states
+    jobs = [(state, {name: panel.get(name)[panel.state_index[state]] for name in names}) for state in states]
+    processes = processes or os.cpu_count()
+    rows = []
+    if processes > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = [pool.submit(state_tests, state, series, pairs, maxlag, diff) for state, series in jobs]
+            for future in futures:
+                rows.extend(future.result())
+    else:
+        for state, series in jobs:
+            rows.extend(state_tests(state, series, pairs, maxlag, diff))
+    df = pd.DataFrame(rows, columns=["State", "Dependent", "Cause", "Lag", "Nobs", "F", "FP", "Chi2", "Chi2P"])
+    if write:
+        conn = store.connect(path)
+        try:
+            make_results_table(conn)
+            conn.executemany("INSERT OR REPLACE INTO granger_results (State, Dependent, Cause, Lag, Nobs, F, FP, Chi2, Chi2P) \
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                [tuple(sql_value(value) for value in row) for row in df.itertuples(index=False)])
+            conn.commit()
+        finally:
+            conn.close()
+    return df
@@ -0,0 +1,145 @@
+# Run instrumentation: stage timers, counters and optional profiling.
+# Nothing is recorded until enable() is called. While disabled, count() is a single flag check and a
+# function decorated with timed() is called directly, so the hooks across the pipeline cost next to nothing.
+#   count(name, amount)  adds to a counter: requests, retries, bytes_fetched and cache_hits when fetching;
+#                        queries, rows_read, rows_written and rows_deleted in the database; panel_loads and
+#                        panel_cache_hits; service_requests, service_cache_hits and service_not_modified
+#   stage(name)          context manager that times a block; timed(name) does the same for a function
+# With profile or memory, the outermost stage running on a thread is also run under cProfile or tracemalloc.
+# report() returns everything as a dict; prometheus() gives the same in the Prometheus text format.
+
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+enabled = False
+profile = False # Run outermost stages under cProfile
+memory = False # Record peak memory of outermost stages with tracemalloc
+profile_rows = 20 # Functions kept per stage profile, by cumulative time
+
+counters = {} # Name -> total
+stages = {} # Name -> {"calls", "seconds"}, plus "peak_bytes" and "profile" when captured
+started = None
+lock = threading.Lock()
+local = threading.local() # Names of the stages open on this thread
+
+def enable(profile_stages=False, trace_memory=False):
+    global enabled, profile, memory, started
+    enabled, profile, memory = True, profile_stages, trace_memory
+    started = started or time.time()
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    global started
+    with lock:
+        counters.clear()
+        stages.clear()
+    started = time.time() if enabled else None
+
+def count(name, amount=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + amount
+
+# Most expensive functions in a profile, by cumulative time.
+def top_functions(profiler):
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line, function), (calls, primitive, own, cumulative, callers) in stats.stats.items():
+        rows.append({"function": function, "file": filename, "line": line, "calls": calls,
+            "seconds": round(own, 6), "cumulative_seconds": round(cumulative, 6)})
+    rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+    return rows[:profile_rows]
+
+@contextmanager
+def stage(name):
+    if not enabled:
+        yield
+        return
+    if not hasattr(local, "stages"):
+        local.stages = []
+    open_stages = local.stages
+    outermost = not open_stages
+    profiler = cProfile.Profile() if profile and outermost else None
+    tracing = memory and outermost and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    open_stages.append(name)
+    if profiler is not None:
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+        open_stages.pop()
+        peak = None
+        if tracing:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        with lock:
+            entry = stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            if peak is not None:
+                entry["peak_bytes"] = max(entry.get("peak_bytes", 0), peak)
+            if profiler is not None:
+                entry["profile"] = top_functions(profiler)
+
+# Decorator that runs a function as a stage.
+def timed(name):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def report():
+    with lock:
+        return {
+            "started": started,
+            "finished": time.time(),
+            "counters": dict(counters),
+            "stages": {name: dict(entry) for name, entry in stages.items()}
+        }
+
+def write_report(path):
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=1)
+
+def metric_name(name):
+    return "".join(c if c.isalnum() else "_" for c in name)
+
+# Counters and stage totals in the Prometheus text exposition format.
+def prometheus(prefix="electrification"):
+    data = report()
+    lines = []
+    for name, value in sorted(data["counters"].items()):
+        metric = prefix+"_"+metric_name(name)+"_total"
+        lines += ["# TYPE "+metric+" counter", metric+" "+repr(value)]
+    for metric, key, kind in [("stage_seconds_total", "seconds", "counter"), ("stage_calls_total", "calls", "counter"), ("stage_peak_bytes", "peak_bytes", "gauge")]:
+        samples = [(name, entry[key]) for name, entry in sorted(data["stages"].items()) if key in entry]
+        if samples:
+            lines.append("# TYPE "+prefix+"_"+metric+" "+kind)
+            lines += [prefix+"_"+metric+'{stage="'+name+'"} '+repr(value) for name, value in samples]
+    return "\n".join(lines)+"\n"
+
+def write_prometheus(path, prefix="electrification"):
+    with open(path, "w") as f:
+        f.write(prometheus(prefix))
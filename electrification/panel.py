@@ -0,0 +1,104 @@
+# In-memory state x year panels shared by analysis.py and plots.py. pandas is only imported for the frame views.
+# load_panel reads the requested series in one bulk query into a dense (series, state, year) array with label
+# indexes. Panels are memoized per database and reused until the database file changes on disk.
+
+import os
+import numpy as np
+import derived
+import instrument
+import store
+
+us = "United States"
+
+class Panel:
+    def __init__(self, values, series, states, years):
+        self.values = values
+        self.series = list(series)
+        self.states = list(states)
+        self.years = np.asarray(years)
+        self.series_index = {name: i for i, name in enumerate(self.series)}
+        self.state_index = {name: i for i, name in enumerate(self.states)}
+
+    # A narrower panel over a subset of series, with its own copy of their values and the same states and years.
+    def select(self, names):
+        return Panel(self.values[[self.series_index[name] for name in names]], names, self.states, self.years)
+
+    # (state, year) array for one series.
+    def get(self, name):
+        return self.values[self.series_index[name]]
+
+    def year_index(self, year):
+        index = int(year) - int(self.years[0]) if len(self.years) else -1
+        if not 0 <= index < len(self.years):
+            raise KeyError("No data for "+str(year))
+        return index
+
+    # One series for one state, indexed by year.
+    def series_for(self, name, state=us):
+        import pandas as pd
+        return pd.Series(self.get(name)[self.state_index[state]], index=self.years, name=name)
+
+    # Several series for one state, indexed by Year.
+    def time_series(self, names, state=us):
+        import pandas as pd
+        df = pd.DataFrame({name: self.get(name)[self.state_index[state]] for name in names}, index=self.years)
+        df.index.name = "Year"
+        return df
+
+    # Several series in one year, indexed by State. Excluded states, the US aggregate by default, are left out.
+    def cross_section(self, names, year, exclude=(us,)):
+        import pandas as pd
+        keep = [i for i, state in enumerate(self.states) if state not in exclude]
+        column = self.year_index(year)
+        df = pd.DataFrame({name: self.get(name)[keep, column] for name in names}, index=[self.states[i] for i in keep])
+        df.index.name = "State"
+        return df
+
+panel_cache = {} # (database path, series) -> (database fingerprint, Panel)
+
+# Changes whenever the database or its write-ahead log is written.
+def db_fingerprint(path):
+    stamp = []
+    for name in [path, path+"-wal"]:
+        try:
+            info = os.stat(name)
+            stamp.append((info.st_mtime_ns, info.st_size))
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+# Panel of the named series, or of every series when names is None.
+# A cached panel is reused, or sliced, as long as the database has not been modified since it was read.
+def load_panel(names=None, path=store.db_path):
+    path = os.path.abspath(path)
+    fingerprint = db_fingerprint(path)
+    for (cached_path, cached_names), (cached_fingerprint, panel) in list(panel_cache.items()):
+        if cached_path != path:
+            continue
+        if cached_fingerprint != fingerprint:
+            del panel_cache[(cached_path, cached_names)]
+        elif names is None and cached_names is None:
+            instrument.count("panel_cache_hits")
+            return panel
+        elif names is not None and set(names) <= set(panel.series):
+            instrument.count("panel_cache_hits")
+            return panel.select(names)
+
+    conn = store.connect(path)
+    try:
+        store.upgrade(conn)
+        if names is None:
+            series = [row[0] for row in conn.execute("SELECT Name FROM series WHERE Frequency = 'A' ORDER BY SeriesId;")]
+        else:
+            series = list(names)
+        values, present, state_ids, years = derived.load_matrix(conn, series)
+        state_names = dict(conn.execute("SELECT StateId, Name FROM states;").fetchall())
+    finally:
+        conn.close()
+    panel = Panel(values, series, [state_names[int(state)] for state in state_ids], years)
+    instrument.count("panel_loads")
+    panel_cache[(path, None if names is None else tuple(names))] = (fingerprint, panel)
+    return panel
+
+def clear_cache():
+    panel_cache.clear()
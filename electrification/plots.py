@@ -1,203 +1,279 @@
 # Plots
+# Every figure is a job in plot_jobs that draws on its own Figure with the Agg backend, so jobs share no pyplot
+# state and can render in parallel across processes. Outputs are written to a temporary file and then renamed.
+# A figure is only re-rendered when the fingerprint of the series it reads, its parameters and its code changes;
+# figures.json in the output directory records fingerprints and what the last run regenerated and how long it took.
+# Run this file to render every figure, or name the figures to render: python plots.py us_elec100 elec_gdp
 
 ###### Imports and set up
 
-import pandas as pd
-import matplotlib.pyplot as plt
-import sqlite3
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.ticker as mtick
+import instrument
+import store
+from panel import load_panel, us
 
-conn = sqlite3.connect("eia.db")
-cur = conn.cursor()
+plot_jobs = {} # Figure name -> (draw function, output file name, series read, parameters, rows read)
+manifest_name = "figures.json"
+
+# Rows a figure reads from its series, for its fingerprint:
+#   us             the US time series
+#   cross_section  every state but the US in the figure's year parameter
+#   panel          every state and year
+row_kinds = ["us", "cross_section", "panel"]
+
+# Register a function that draws on a Figure as a plot job, named after the output file without its extension.
+# series lists every series the figure reads and rows which of their rows (see row_kinds); params are passed to
+# the draw function as keyword arguments.
+def plot_job(output, series, rows="panel", **params):
+    if rows not in row_kinds:
+        raise ValueError("Unknown rows: "+str(rows))
+    def register(draw):
+        plot_jobs[os.path.splitext(output)[0]] = (draw, output, list(series), params, rows)
+        return draw
+    return register
 
-# List of state names in the database
-states = cur.execute("SELECT DISTINCT State FROM electrification;")
-state_names = []
-for row in states:
-    state_names.append(row[0])
-    
 ###### Plots
 
-def electrification_plot():
+@plot_job("us_elec100.svg", ["electrification"], rows="us")
+def electrification_plot(fig):
     ###### Set up data
-    df = pd.read_sql_query("SELECT * FROM electrification WHERE State = 'United States';",conn)
-    df["Value"] = 100*2.5*df["Value"] # Assuming a primary energy factor of 2.5. The factor of 100 is for percentages.
+    df = load_panel(["electrification"]).series_for("electrification")
+    df = 100*2.5*df # Assuming a primary energy factor of 2.5. The factor of 100 is for percentages.
 
     ###### Electrification Plot
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
-    ax.plot(df["Year"],df["Value"],color="#333333")
+    ax.plot(df.index,df,color="#333333")
 
     ax.yaxis.set_major_formatter(mtick.PercentFormatter())
-    plt.ylim(0,100)
-    plt.ylabel("Electrification Rate")
-    plt.title("Electrification in the United States")
-    plt.savefig("us_elec100.svg")
-    plt.clf()
+    ax.set_ylim(0,100)
+    ax.set_ylabel("Electrification Rate")
+    ax.set_title("Electrification in the United States")
 
-def electrification_plot_states():
+@plot_job("us_elec_states.svg", ["electrification"])
+def electrification_plot_states(fig):
     ###### Set up data
-    df = pd.read_sql_query("SELECT * FROM electrification WHERE State = 'United States';",conn)
-    df["Value"] = 100*2.5*df["Value"] # Assuming a primary energy factor of 2.5. The factor of 100 is for percentages.
+    panel = load_panel(["electrification"])
+    values = 100*2.5*panel.get("electrification") # Assuming a primary energy factor of 2.5. The factor of 100 is for percentages.
 
     ###### Electrification Plot
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
-    for i in range(len(state_names)):
-        if state_names[i] != "United States":
-            df = pd.read_sql_query("SELECT * FROM electrification WHERE State = '"+state_names[i]+"';",conn)
-            df["Value"] = 100*2.5*df["Value"] # Assuming a primary energy factor of 2.5. The factor of 100 is for percentages.
-            ax.plot(df["Year"],df["Value"], linewidth = 1, color="#333333",alpha=0.5)
-    df = pd.read_sql_query("SELECT * FROM electrification WHERE State = 'United States';",conn)
-    df["Value"] = 100*2.5*df["Value"] # Assuming a primary energy factor of 2.5. The factor of 100 is for percentages.
-    ax.plot(df["Year"],df["Value"], linewidth = 5, color='black')
+    for i in range(len(panel.states)):
+        if panel.states[i] != "United States":
+            ax.plot(panel.years,values[i], linewidth = 1, color="#333333",alpha=0.5)
+    ax.plot(panel.years,values[panel.state_index["United States"]], linewidth = 5, color='black')
 
     ax.yaxis.set_major_formatter(mtick.PercentFormatter())
-    plt.ylabel("Electrification Rate")
-    plt.title("Electrification in the US and States")
-    plt.savefig("us_elec_states.svg")
-    plt.clf()
+    ax.set_ylabel("Electrification Rate")
+    ax.set_title("Electrification in the US and States")
 
-def price_plot():
+@plot_job("us_elec_price.svg", ["electricity_price_share"], rows="us")
+def price_plot(fig):
     ###### Set up data for prices
-    df = pd.read_sql_query("SELECT * FROM electricity_price_share WHERE State = 'United States';",conn)
-    init_value = df["Value"][0]
+    df = load_panel(["electricity_price_share"]).series_for("electricity_price_share").dropna()
+    init_value = df.iloc[0]
 
     ###### Price Plot
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
-    ax.plot(df["Year"],df["Value"],color="#333333")
-
-    plt.title("United States Electricity-Energy Price Ratio")
-    plt.savefig("us_elec_price.svg")
-    plt.clf()
-
-def price_electrification_by_state():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, electricity_price_share.Value AS ElecPriceShare \
-        FROM electrification JOIN electricity_price_share \
-        ON electrification.Year = electricity_price_share.Year AND electrification.State = electricity_price_share.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States';",conn)
-    fig = plt.figure(1, (7, 4))
+    ax.plot(df.index,df,color="#333333")
+
+    ax.set_title("United States Electricity-Energy Price Ratio")
+
+@plot_job("elec_elec_price_state.svg", ["electrification", "electricity_price_share"], rows="cross_section", year=2019)
+def price_electrification_by_state(fig, year):
+    names = ["electrification", "electricity_price_share"]
+    df = load_panel(names).cross_section(names, year).dropna()
+    df.columns = ["Elec", "ElecPriceShare"]
     ax = fig.add_subplot(1, 1, 1)
     ax.plot(250*df["Elec"],df["ElecPriceShare"],'bo',color="#333333")
     ax.xaxis.set_major_formatter(mtick.PercentFormatter())
 
-    plt.xlabel("Electrification")
-    plt.ylabel("Electricity to Energy Price Ratio")
-    plt.title("Electrification and Prices by State in 2019")
-    plt.savefig("elec_elec_price_state.svg")
-    plt.clf()
-    
-def elec_gdp():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, gdp_per_capita.Value AS GDPCap \
-        FROM electrification JOIN gdp_per_capita \
-        ON electrification.Year = gdp_per_capita.Year AND electrification.State = gdp_per_capita.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States';",conn)
+    ax.set_xlabel("Electrification")
+    ax.set_ylabel("Electricity to Energy Price Ratio")
+    ax.set_title("Electrification and Prices by State in "+str(year))
+
+@plot_job("elec_gdp_capita.png", ["electrification", "gdp_per_capita"], rows="cross_section", year=2019)
+def elec_gdp(fig, year):
+    names = ["electrification", "gdp_per_capita"]
+    df = load_panel(names).cross_section(names, year).dropna()
+    df.columns = ["Elec", "GDPCap"]
     
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
     ax.plot(df["Elec"],df["GDPCap"],'bo')
 
-    plt.xlabel("Electrification")
-    plt.ylabel("GDP Per Capita")
-    plt.savefig("elec_gdp_capita.png")
-    plt.clf()
-    
-def elec_transportation():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, transportation_share.Value AS TranspoShare \
-        FROM electrification JOIN transportation_share \
-        ON electrification.Year = transportation_share.Year AND electrification.State = transportation_share.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States';",conn)
+    ax.set_xlabel("Electrification")
+    ax.set_ylabel("GDP Per Capita")
+
+@plot_job("elec_transpo.png", ["electrification", "transportation_share"], rows="cross_section", year=2019)
+def elec_transportation(fig, year):
+    names = ["electrification", "transportation_share"]
+    df = load_panel(names).cross_section(names, year).dropna()
+    df.columns = ["Elec", "TranspoShare"]
     
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
     ax.plot(df["Elec"],df["TranspoShare"],'bo')
 
-    plt.xlabel("Electrification")
-    plt.ylabel("Transportation Share")
-    plt.savefig("elec_transpo.png")
-    plt.clf()
-    
-def elec_industry():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, industrial_share.Value AS IndustryShare \
-        FROM electrification JOIN industrial_share \
-        ON electrification.Year = industrial_share.Year AND electrification.State = industrial_share.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States';",conn)
+    ax.set_xlabel("Electrification")
+    ax.set_ylabel("Transportation Share")
+
+@plot_job("elec_industry.png", ["electrification", "industrial_share"], rows="cross_section", year=2019)
+def elec_industry(fig, year):
+    names = ["electrification", "industrial_share"]
+    df = load_panel(names).cross_section(names, year).dropna()
+    df.columns = ["Elec", "IndustryShare"]
     
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
     ax.plot(df["Elec"],df["IndustryShare"],'bo')
 
-    plt.xlabel("Electrification")
-    plt.ylabel("Industrial Share")
-    plt.savefig("elec_industry.png")
-    plt.clf()
-    
-def elec_residential():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, residential_share.Value AS ResShare \
-        FROM electrification JOIN residential_share \
-        ON electrification.Year = residential_share.Year AND electrification.State = residential_share.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States';",conn)
+    ax.set_xlabel("Electrification")
+    ax.set_ylabel("Industrial Share")
+
+@plot_job("elec_res.png", ["electrification", "residential_share"], rows="cross_section", year=2019)
+def elec_residential(fig, year):
+    names = ["electrification", "residential_share"]
+    df = load_panel(names).cross_section(names, year).dropna()
+    df.columns = ["Elec", "ResShare"]
     
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
     ax.plot(df["Elec"],df["ResShare"],'bo')
 
-    plt.xlabel("Electrification")
-    plt.ylabel("Residential Share")
-    plt.savefig("elec_res.png")
-    plt.clf()
-    
-def elec_commercial():
-    df = pd.read_sql_query("SELECT electrification.State as State, electrification.Value AS Elec, commercial_share.Value AS CommShare \
-        FROM electrification JOIN commercial_share \
-        ON electrification.Year = commercial_share.Year AND electrification.State = commercial_share.State \
-        WHERE electrification.Year = '2019' AND electrification.State != 'United States';",conn)
+    ax.set_xlabel("Electrification")
+    ax.set_ylabel("Residential Share")
+
+@plot_job("elec_comm.png", ["electrification", "commercial_share"], rows="cross_section", year=2019)
+def elec_commercial(fig, year):
+    names = ["electrification", "commercial_share"]
+    df = load_panel(names).cross_section(names, year).dropna()
+    df.columns = ["Elec", "CommShare"]
     
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
     ax.plot(df["Elec"],df["CommShare"],'bo')
 
-    plt.xlabel("Electrification")
-    plt.ylabel("Commercial Share")
-    plt.savefig("elec_comm.png")
-    plt.clf()
-    
-def elec_by_sector():
-    df_elec = pd.read_sql_query("SELECT * FROM electrification WHERE State = 'United States';",conn)
-    df_elec_res = pd.read_sql_query("SELECT * FROM residential_electrification WHERE State = 'United States';",conn)
-    df_elec_comm = pd.read_sql_query("SELECT * FROM commercial_electrification WHERE State = 'United States';",conn)
-    df_elec_ind = pd.read_sql_query("SELECT * FROM industrial_electrification WHERE State = 'United States';",conn)
-    df_elec_transpo = pd.read_sql_query("SELECT * FROM transportation_electrification WHERE State = 'United States';",conn)
+    ax.set_xlabel("Electrification")
+    ax.set_ylabel("Commercial Share")
+
+@plot_job("elec_by_sector.svg", ["electrification", "residential_electrification", "commercial_electrification", "industrial_electrification", "transportation_electrification"], rows="us")
+def elec_by_sector(fig):
+    names = ["electrification", "residential_electrification", "commercial_electrification", "industrial_electrification", "transportation_electrification"]
+    df = load_panel(names).time_series(names)
     
-    fig = plt.figure(1, (7, 4))
     ax = fig.add_subplot(1, 1, 1)
-    ax.plot(df_elec_comm["Year"],100*2.5*df_elec_comm["Value"],label="Commercial",color="#333333",linewidth=1)
-    ax.plot(df_elec_res["Year"],100*2.5*df_elec_res["Value"],label="Residential",color="#333333",linewidth=1)
-    ax.plot(df_elec["Year"],100*2.5*df_elec["Value"],label="Overall",color="#333333",linewidth=2)
-    ax.plot(df_elec_ind["Year"],100*2.5*df_elec_ind["Value"],label="Industrial",color="#333333",linewidth=1)
-    ax.plot(df_elec_transpo["Year"],100*2.5*df_elec_transpo["Value"],label="Transpo.",color="#333333",linewidth=1)
+    ax.plot(df.index,100*2.5*df["commercial_electrification"],label="Commercial",color="#333333",linewidth=1)
+    ax.plot(df.index,100*2.5*df["residential_electrification"],label="Residential",color="#333333",linewidth=1)
+    ax.plot(df.index,100*2.5*df["electrification"],label="Overall",color="#333333",linewidth=2)
+    ax.plot(df.index,100*2.5*df["industrial_electrification"],label="Industrial",color="#333333",linewidth=1)
+    ax.plot(df.index,100*2.5*df["transportation_electrification"],label="Transpo.",color="#333333",linewidth=1)
     ax.text(1983,55,"Commercial")
     ax.text(1990,43,"Residential")
     ax.text(1990,29,"Overall")
     ax.text(1990,22,"Industrial")
     ax.text(1990,1.5,"Transportation")
-    plt.ylabel("Electrification")
-    #plt.legend()
+    ax.set_ylabel("Electrification")
+    #ax.legend()
     ax.yaxis.set_major_formatter(mtick.PercentFormatter())
-    
-    plt.savefig("elec_by_sector.svg")
-    plt.clf()    
-    
-# Create image files in this same directory.
 
-electrification_plot()
-electrification_plot_states()
-price_plot()
-price_electrification_by_state()
-elec_gdp()
-elec_transportation()
-elec_industry()
-elec_residential()
-elec_commercial()
-elec_by_sector()
+###### Rendering
+
+# Hash of everything a figure depends on: the rows it reads from its series, its parameters and its code.
+# Rows are taken in order of state name, and only states and years with data count, so the hash depends neither on
+# state ids nor on the axes of a larger panel this one was selected from.
+def fingerprint(name):
+    draw, output, series, params, rows = plot_jobs[name]
+    panel = load_panel(series)
+    if rows == "us":
+        states = [us] if us in panel.state_index else []
+    else:
+        states = sorted(state for state in panel.states if rows == "panel" or state != us)
+    values = panel.values[:, [panel.state_index[state] for state in states]]
+    if rows == "cross_section":
+        values = np.where(panel.years == int(params["year"]), values, np.nan)
+    has_data = np.isfinite(values)
+    keep_states, keep_years = has_data.any(axis=(0, 2)), has_data.any(axis=(0, 1))
+    digest = hashlib.sha256()
+    digest.update(json.dumps([name, output, series, params, rows, [state for state, keep in zip(states, keep_states) if keep], panel.years[keep_years].tolist()],
+        sort_keys=True, default=str).encode())
+    digest.update(np.ascontiguousarray(values[:, keep_states][:, :, keep_years]).tobytes())
+    digest.update(inspect.getsource(draw).encode())
+    return digest.hexdigest()
+
+# Draw one figure on its own Figure and write it to outdir atomically. Returns the output path and seconds taken.
+def render(name, outdir="."):
+    start = time.perf_counter()
+    draw, output, series, params, rows = plot_jobs[name]
+    fig = Figure(figsize=(7, 4))
+    FigureCanvasAgg(fig)
+    draw(fig, **params)
+    path = os.path.join(outdir, output)
+    handle, tmp = tempfile.mkstemp(dir=outdir, prefix="."+name+".", suffix=os.path.splitext(output)[1])
+    try:
+        with os.fdopen(handle, "wb") as f:
+            fig.savefig(f, format=os.path.splitext(output)[1][1:])
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return path, time.perf_counter() - start
+
+# Render the named figures, or all of them, across a process pool.
+# Figures whose output exists with an unchanged fingerprint are skipped unless force is set.
+# Returns the manifest entries of this run: one per figure, with its status and seconds taken.
+@instrument.timed("render")
+def render_all(names=None, outdir=".", processes=None, force=False):
+    names = list(names) if names else list(plot_jobs)
+    unknown = [name for name in names if name not in plot_jobs]
+    if unknown:
+        raise KeyError("Unknown figures: "+", ".join(unknown))
+    os.makedirs(outdir, exist_ok=True)
+    load_panel(list(dict.fromkeys(series for name in names for series in plot_jobs[name][2]))) # One read for every figure
+    manifest = store.read_manifest(os.path.join(outdir, manifest_name), {"figures": {}})
+    fingerprints = {name: fingerprint(name) for name in names}
+    stale = [name for name in names if force
+        or manifest["figures"].get(name, {}).get("fingerprint") != fingerprints[name]
+        or not os.path.exists(os.path.join(outdir, plot_jobs[name][1]))]
+
+    processes = processes or os.cpu_count()
+    if processes == 1 or len(stale) <= 1:
+        results = [render(name, outdir) for name in stale]
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes, len(stale))) as pool:
+            results = list(pool.map(render, stale, [outdir]*len(stale)))
+
+    run = []
+    for name, (path, seconds) in zip(stale, results):
+        manifest["figures"][name] = {"output": plot_jobs[name][1], "fingerprint": fingerprints[name], "seconds": round(seconds, 4), "rendered_at": time.time()}
+        run.append({"figure": name, "output": path, "status": "rendered", "seconds": round(seconds, 4)})
+    for name in names:
+        if name not in stale:
+            run.append({"figure": name, "output": os.path.join(outdir, plot_jobs[name][1]), "status": "skipped", "seconds": 0.0})
+    manifest["last_run"] = run
+    store.write_manifest(os.path.join(outdir, manifest_name), manifest)
+    return run
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render the electrification figures.")
+    parser.add_argument("figures", nargs="*", help="figures to render (default: all)")
+    parser.add_argument("--out", default=".", help="directory for the image files")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="render even if nothing changed")
+    parser.add_argument("--list", action="store_true", help="list the figures and exit")
+    args = parser.parse_args(argv)
+    if args.list:
+        for name, (draw, output, series, params) in plot_jobs.items():
+            print(name+"\t"+output)
+        return
+    for entry in render_all(args.figures, args.out, args.processes, args.force):
+        print(entry["status"]+"\t"+entry["output"]+"\t"+format(entry["seconds"], ".2f")+" s")
+
+# Create image files in this same directory.
+if __name__ == "__main__":
+    main()
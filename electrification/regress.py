@@ -0,0 +1,77 @@
+# Batch cross-state regressions.
+# Every (predictor, dependent, year) combination is a simple OLS of the dependent on the predictor across states.
+# They are all solved at once from masked sums over stacked arrays, so a sweep over every pair of series and
+# every year is one call. Full statsmodels summaries are only computed on request, by fit_summary.
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+import instrument
+from panel import load_panel, us
+
+# Simple OLS of y on x with an intercept along the last axis, batched over all leading axes.
+# Pairs with a missing x or y are left out of each fit. Returns a dict of arrays with the leading shape.
+def ols(x, y):
+    x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    mask = np.isfinite(x) & np.isfinite(y)
+    n = mask.sum(axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_x = np.where(mask, x, 0).sum(axis=-1) / n
+        mean_y = np.where(mask, y, 0).sum(axis=-1) / n
+        dx = np.where(mask, x - mean_x[..., None], 0)
+        dy = np.where(mask, y - mean_y[..., None], 0)
+        sxx = (dx*dx).sum(axis=-1)
+        sxy = (dx*dy).sum(axis=-1)
+        syy = (dy*dy).sum(axis=-1)
+        slope = sxy / sxx
+        intercept = mean_y - slope*mean_x
+        ssr = np.maximum(syy - slope*sxy, 0)
+        df_resid = n - 2
+        sigma2 = ssr / df_resid
+        slope_se = np.sqrt(sigma2 / sxx)
+        intercept_se = np.sqrt(sigma2 * (1.0/n + mean_x**2/sxx))
+        slope_t = slope / slope_se
+        intercept_t = intercept / intercept_se
+        r2 = 1 - ssr/syy
+    return {
+        "N": n,
+        "Intercept": intercept,
+        "Slope": slope,
+        "InterceptSE": intercept_se,
+        "SlopeSE": slope_se,
+        "InterceptP": 2*stats.t.sf(np.abs(intercept_t), df_resid),
+        "SlopeT": slope_t,
+        "SlopeP": 2*stats.t.sf(np.abs(slope_t), df_resid),
+        "R2": r2
+    }
+
+# (series, year, state) array of cross sections, leaving out excluded states.
+def cross_sections(panel, names, years, exclude=(us,)):
+    rows = [i for i, state in enumerate(panel.states) if state not in exclude]
+    columns = [panel.year_index(year) for year in years]
+    return np.stack([panel.get(name)[rows][:, columns].T for name in names])
+
+# Fit every combination of predictor, dependent and year across states in one pass.
+# Returns one row per (Predictor, Dependent, Year) with coefficients, standard errors, p-values and R2.
+@instrument.timed("regress")
+def batch_regression(predictors, dependents, years, exclude=(us,), panel=None):
+    predictors, dependents, years = list(predictors), list(dependents), [int(year) for year in years]
+    panel = panel or load_panel(list(dict.fromkeys(predictors+dependents)))
+    x = cross_sections(panel, predictors, years, exclude)[:, None]
+    y = cross_sections(panel, dependents, years, exclude)[None, :]
+    fit = ols(x, y)
+    index = pd.MultiIndex.from_product([predictors, dependents, years], names=["Predictor", "Dependent", "Year"])
+    return pd.DataFrame({name: np.broadcast_to(values, index.levshape).ravel() for name, values in fit.items()}, index=index).reset_index()
+
+# Full statsmodels OLS fit of y on x, with names used in the summary.
+def fit_arrays(x, y, predictor="x1", dependent="y"):
+    import statsmodels.api as sm
+    df = pd.DataFrame({predictor: x, dependent: y}).dropna()
+    return sm.OLS(df[dependent], sm.add_constant(df[predictor])).fit()
+
+# Full statsmodels OLS fit for one predictor, dependent and year across states.
+@instrument.timed("fit")
+def fit_summary(predictor, dependent, year, exclude=(us,), panel=None):
+    panel = panel or load_panel([predictor, dependent])
+    df = panel.cross_section([predictor, dependent], year, exclude)
+    return fit_arrays(df[predictor], df[dependent], predictor, dependent)
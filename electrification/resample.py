@@ -0,0 +1,133 @@
+# Resampling inference for the cross-state regressions of regress.py.
+# Every (predictor, dependent, year) cross section is a simple OLS across states. The slope only depends on
+# six sums over states (count, x, y, x*x, x*y, y*y), so thousands of resamples are computed together:
+#   bootstrap     states are drawn with replacement; the sums for a batch of draws are one matrix product of
+#                 the draw counts with the per-state terms of every cross section
+#   permutation   the dependent is shuffled across states. Where every state has both values, the centered
+#                 sums other than x*y do not change under a shuffle, so only one product is gathered per shuffle
+#   leave one out each state is dropped in turn by subtracting its terms from the full sums
+# As in regress.ols, pairs with a missing value drop out of each fit. Batches are seeded from one
+# SeedSequence, so results depend only on the seed and not on how batches are spread across processes.
+
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import instrument
+import regress
+from panel import load_panel, us
+
+resamples = 10000
+batch_size = 250 # Resamples per batch
+gather_size = 25 # Permutations gathered at once within a batch, to bound memory
+
+# Per-state terms of the OLS sums, as a (6, cross section, state) array. Values are centered on each cross
+# section's mean first, which leaves the slope unchanged and keeps the sums well conditioned.
+def terms(x, y):
+    mask = np.isfinite(x) & np.isfinite(y)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # Cross sections with no pairs
+        x = np.where(mask, x - np.nanmean(np.where(mask, x, np.nan), axis=-1, keepdims=True), 0)
+        y = np.where(mask, y - np.nanmean(np.where(mask, y, np.nan), axis=-1, keepdims=True), 0)
+    return np.stack([mask.astype(float), x, y, x*x, x*y, y*y])
+
+def slopes(sums):
+    n, sx, sy, sxx, sxy, syy = sums
+    with np.errstate(invalid="ignore", divide="ignore"):
+        slope = (n*sxy - sx*sy) / (n*sxx - sx*sx)
+    return np.where(n > 2, slope, np.nan)
+
+# Slopes for count bootstrap draws, as a (draw, cross section) array.
+def bootstrap_batch(seed, count, x, y):
+    rng = np.random.default_rng(seed)
+    parts = terms(x, y)
+    weights = rng.multinomial(x.shape[-1], np.full(x.shape[-1], 1.0/x.shape[-1]), size=count).astype(float)
+    return slopes(np.einsum("bn,tkn->tbk", weights, parts, optimize=True))
+
+# Number of permutations, out of count, whose slope is at least as far from zero as the observed slope.
+def permutation_batch(seed, count, x, y, observed):
+    rng = np.random.default_rng(seed)
+    mask_x, mask_y = np.isfinite(x), np.isfinite(y)
+    complete = (mask_x & mask_y).all(axis=-1)
+    parts = terms(x[complete], y[complete])
+    xc, yc = parts[1], parts[2] # Centered, so the slope of a shuffle is its x*y sum over the fixed x*x sum
+    bound = np.abs(observed[complete]) * parts[3].sum(axis=-1) * (1 - 1e-12) # Ties count as extreme
+    mx, xp = mask_x[~complete].astype(float)[:, None, :], np.where(mask_x, x, 0)[~complete][:, None, :]
+    my0, y0 = mask_y[~complete].astype(float), np.where(mask_y, y, 0)[~complete]
+    threshold = np.abs(observed[~complete])[:, None] * (1 - 1e-12)
+    extreme = np.zeros(len(observed), int)
+    for start in range(0, count, gather_size):
+        order = np.argsort(rng.random((min(gather_size, count - start), x.shape[-1])), axis=1)
+        shuffled = np.einsum("kn,kgn->kg", xc, yc[:, order]) # (cross section, permutation)
+        extreme[complete] += (np.abs(shuffled) >= bound[:, None]).sum(axis=1)
+        if len(y0):
+            my, yp = my0[:, order], y0[:, order]
+            sums = np.stack([(mx*my).sum(-1), (xp*my).sum(-1), (mx*yp).sum(-1), (xp*xp*my).sum(-1), (xp*yp).sum(-1), (mx*yp*yp).sum(-1)])
+            extreme[~complete] += (np.abs(slopes(sums)) >= threshold).sum(axis=1)
+    return extreme
+
+# Slopes with each state left out, as a (cross section, state) array; NaN where the state had no pair.
+def leave_one_out(x, y):
+    parts = terms(x, y)
+    dropped = slopes(parts.sum(axis=-1)[..., None] - parts)
+    return np.where(parts[0] > 0, dropped, np.nan)
+
+# Run total resamples in batches across a process pool as fn(seed, count, *args), seeding batch i from the
+# i-th child of seed. Returns the result of each batch.
+def run_batches(fn, total, seed, processes, *args):
+    counts = [min(batch_size, total - start) for start in range(0, total, batch_size)]
+    seeds = seed.spawn(len(counts))
+    processes = processes or os.cpu_count()
+    if processes == 1 or len(counts) == 1:
+        return [fn(child, count, *args) for child, count in zip(seeds, counts)]
+    with ProcessPoolExecutor(max_workers=min(processes, len(counts))) as pool:
+        futures = [pool.submit(fn, child, count, *args) for child, count in zip(seeds, counts)]
+        return [future.result() for future in futures]
+
+# Bootstrap confidence intervals and permutation p-values for the slope of every combination of predictor,
+# dependent and year across states. Returns one row per (Predictor, Dependent, Year) with the OLS slope, the
+# bootstrap standard error and percentile interval at level, and the two-sided permutation p-value.
+@instrument.timed("resample")
+def resample(predictors, dependents, years, resamples=resamples, seed=0, level=0.95, processes=None, exclude=(us,), panel=None):
+    predictors, dependents, years = list(predictors), list(dependents), [int(year) for year in years]
+    panel = panel or load_panel(list(dict.fromkeys(predictors+dependents)))
+    x = regress.cross_sections(panel, predictors, years, exclude)[:, None]
+    y = regress.cross_sections(panel, dependents, years, exclude)[None, :]
+    x, y = np.broadcast_arrays(x, y)
+    x, y = x.reshape(-1, x.shape[-1]), y.reshape(-1, y.shape[-1])
+    observed = slopes(terms(x, y).sum(axis=-1))
+    seeds = np.random.SeedSequence(seed).spawn(2)
+    draws = np.concatenate(run_batches(bootstrap_batch, resamples, seeds[0], processes, x, y))
+    extreme = sum(run_batches(permutation_batch, resamples, seeds[1], processes, x, y, observed))
+    tail = (1 - level) / 2
+    index = pd.MultiIndex.from_product([predictors, dependents, years], names=["Predictor", "Dependent", "Year"])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # Cross sections with too few pairs to fit
+        low, high = np.nanquantile(draws, [tail, 1 - tail], axis=0)
+        se = np.nanstd(draws, axis=0, ddof=1)
+    return pd.DataFrame({
+        "N": (np.isfinite(x) & np.isfinite(y)).sum(axis=-1),
+        "Slope": observed,
+        "BootstrapSE": se,
+        "CILow": low,
+        "CIHigh": high,
+        "PermutationP": np.where(np.isfinite(observed), (1 + extreme) / (1 + resamples), np.nan)
+    }, index=index).reset_index()
+
+# Leave-one-state-out slopes for every combination of predictor, dependent and year. Returns one row per
+# (Predictor, Dependent, Year, State) with the slope without that state and its change from the full slope.
+@instrument.timed("resample")
+def influence(predictors, dependents, years, exclude=(us,), panel=None):
+    predictors, dependents, years = list(predictors), list(dependents), [int(year) for year in years]
+    panel = panel or load_panel(list(dict.fromkeys(predictors+dependents)))
+    x = regress.cross_sections(panel, predictors, years, exclude)[:, None]
+    y = regress.cross_sections(panel, dependents, years, exclude)[None, :]
+    x, y = np.broadcast_arrays(x, y)
+    x, y = x.reshape(-1, x.shape[-1]), y.reshape(-1, y.shape[-1])
+    full = slopes(terms(x, y).sum(axis=-1))
+    dropped = leave_one_out(x, y)
+    states = [state for state in panel.states if state not in exclude]
+    index = pd.MultiIndex.from_product([predictors, dependents, years, states], names=["Predictor", "Dependent", "Year", "State"])
+    df = pd.DataFrame({"Slope": dropped.ravel(), "Influence": (full[:, None] - dropped).ravel()}, index=index).reset_index()
+    return df.dropna(subset=["Slope"])
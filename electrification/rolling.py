@@ -0,0 +1,89 @@
+# Rolling-window and year-over-year analytics for every state and year of the panel at once.
+# Rolling regressions fit one series on another over a trailing window of years within each state. The window
+# sums an OLS needs (count, x, y, x*x, x*y, y*y) come from cumulative sums along the year axis, so every
+# window of every state costs two subtractions rather than a refit. Growth rates and elasticities are
+# differences along the same axis. Results are tidy DataFrames indexed by (State, Year).
+
+import warnings
+import numpy as np
+import pandas as pd
+import instrument
+from panel import load_panel
+
+window = 10 # Years in a rolling window
+
+# (state, year) arrays as a DataFrame indexed by (State, Year), one column per array.
+def frame(panel, columns):
+    index = pd.MultiIndex.from_product([panel.states, panel.years], names=["State", "Year"])
+    return pd.DataFrame({name: np.asarray(values).ravel() for name, values in columns.items()}, index=index)
+
+# Sums over trailing windows along the last axis, from cumulative sums. Windows that start before the first
+# year cover the years available.
+def window_sums(values, size):
+    totals = np.cumsum(values, axis=-1)
+    shifted = np.zeros_like(totals)
+    shifted[..., size:] = totals[..., :-size]
+    return totals - shifted
+
+# Trailing-window OLS of y on x along the last axis, for every leading index and every end year.
+# Pairs with a missing value are left out. Windows with fewer than min_periods pairs are NaN.
+def rolling_ols(x, y, size=window, min_periods=None):
+    min_periods = min_periods or size
+    mask = np.isfinite(x) & np.isfinite(y)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # States with no pairs
+        x_shift = np.nanmean(np.where(mask, x, np.nan), axis=-1, keepdims=True)
+        y_shift = np.nanmean(np.where(mask, y, np.nan), axis=-1, keepdims=True)
+    dx, dy = np.where(mask, x - x_shift, 0), np.where(mask, y - y_shift, 0) # Centered for well-conditioned sums
+    n, sx, sy, sxx, sxy, syy = (window_sums(values, size) for values in [mask.astype(float), dx, dy, dx*dx, dx*dy, dy*dy])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_x, mean_y = sx/n, sy/n
+        vxx, vxy, vyy = sxx - n*mean_x**2, sxy - n*mean_x*mean_y, syy - n*mean_y**2
+        slope = vxy/vxx
+        r2 = vxy**2/(vxx*vyy)
+        intercept = (mean_y + y_shift) - slope*(mean_x + x_shift)
+    ok = n >= max(min_periods, 2)
+    return {
+        "N": n.astype(int),
+        "Slope": np.where(ok, slope, np.nan),
+        "Intercept": np.where(ok, intercept, np.nan),
+        "R2": np.where(ok, r2, np.nan)
+    }
+
+# Rolling regression of dependent on predictor within each state over trailing windows of size years.
+# Returns N, Slope, Intercept and R2 indexed by (State, Year), where Year is the last year of the window.
+@instrument.timed("rolling")
+def rolling_regression(predictor, dependent, size=window, min_periods=None, panel=None):
+    panel = panel or load_panel([predictor, dependent])
+    return frame(panel, rolling_ols(panel.get(predictor), panel.get(dependent), size, min_periods))
+
+# Change over periods years, as a (state, year) array: relative growth, or the change in logs with log=True.
+def growth(values, periods=1, log=False):
+    result = np.full(values.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if log:
+            result[..., periods:] = np.log(values[..., periods:]) - np.log(values[..., :-periods])
+        else:
+            result[..., periods:] = values[..., periods:]/values[..., :-periods] - 1
+    return result
+
+# Growth of each series over periods years, indexed by (State, Year) with Year the end of the period.
+@instrument.timed("rolling")
+def growth_rates(names, periods=1, log=False, panel=None):
+    panel = panel or load_panel(list(names))
+    return frame(panel, {name: growth(panel.get(name), periods, log) for name in names})
+
+# Elasticity of dependent with respect to predictor for every state and year: the change in log dependent over
+# the change in log predictor across periods years. With size, also the rolling elasticity, the slope of a
+# trailing-window regression of the yearly log changes on each other.
+@instrument.timed("rolling")
+def elasticities(predictor, dependent, periods=1, size=None, panel=None):
+    panel = panel or load_panel([predictor, dependent])
+    dx, dy = growth(panel.get(predictor), periods, log=True), growth(panel.get(dependent), periods, log=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        columns = {"Elasticity": np.where(dx != 0, dy/dx, np.nan)}
+    if size is not None:
+        yearly = rolling_ols(growth(panel.get(predictor), log=True), growth(panel.get(dependent), log=True), size)
+        columns["RollingElasticity"] = yearly["Slope"]
+        columns["RollingN"] = yearly["N"]
+    return frame(panel, columns)
@@ -0,0 +1,202 @@
+# Precomputed rollups of the annual series for the common analysis queries.
+#   rollup_stats          for every series and year: count, mean, variance, min, quartiles and max across states,
+#                         leaving out the US aggregate and any geography that is not a state
+#   rollup_vectors        every series as one vector per year (a cross section over states) and one per state
+#                         (a time series over years), each stored as packed arrays of keys and values
+#   rollup_decomposition  the cross-state variance decomposition of decompose.decompose_states for every year
+# rollup_versions records the series versions each rollup was computed from. refresh() recomputes only the
+# series, and the decomposition, whose inputs changed, and runs after every ingest in build_db.
+# Readers are single indexed lookups, so a variance or a cross section costs the same however many rows
+# the database holds.
+
+import json
+import warnings
+import numpy as np
+import derived
+import instrument
+import store
+from panel import us
+
+stat_names = ["N", "Mean", "Variance", "Min", "Q25", "Median", "Q75", "Max"]
+year_axis = "Y" # Vector over states for one year
+state_axis = "S" # Vector over years for one state
+decomposition_name = "decomposition" # Key of the decomposition in rollup_versions
+
+def create_tables(conn):
+    store.upgrade(conn)
+    conn.execute("CREATE TABLE IF NOT EXISTS rollup_stats( \
+        SeriesId int NOT NULL, \
+        Year int NOT NULL, \
+        "+", ".join(name+(" int" if name == "N" else " FLOAT") for name in stat_names)+", \
+        PRIMARY KEY (SeriesId, Year) \
+    ) WITHOUT ROWID;")
+    conn.execute("CREATE TABLE IF NOT EXISTS rollup_vectors( \
+        SeriesId int NOT NULL, \
+        Axis CHAR(1) NOT NULL, \
+        Key int NOT NULL, \
+        Keys BLOB NOT NULL, \
+        Vals BLOB NOT NULL, \
+        PRIMARY KEY (SeriesId, Axis, Key) \
+    ) WITHOUT ROWID;")
+    conn.execute("CREATE TABLE IF NOT EXISTS rollup_decomposition( \
+        Year int PRIMARY KEY, \
+        Variance FLOAT, \
+        ConstantShares FLOAT, \
+        ConstantRates FLOAT, \
+        WithinShare FLOAT, \
+        BetweenShare FLOAT \
+    );")
+    conn.execute("CREATE TABLE IF NOT EXISTS rollup_versions( \
+        Name VARCHAR(64) PRIMARY KEY, \
+        InputVersions TEXT \
+    );")
+
+def sql_float(value):
+    return None if np.isnan(value) else float(value)
+
+# Stats across states for every year of a (state, year) array, as a dict of arrays over years.
+def summary_stats(values):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning) # Years with no data give NaN
+        quartiles = np.nanquantile(values, [0.25, 0.5, 0.75], axis=0) if values.shape[0] else np.full((3, values.shape[1]), np.nan)
+        return {
+            "N": np.isfinite(values).sum(axis=0),
+            "Mean": np.nanmean(values, axis=0),
+            "Variance": np.nanvar(values, axis=0),
+            "Min": np.nanmin(values, axis=0) if values.shape[0] else np.full(values.shape[1], np.nan),
+            "Q25": quartiles[0],
+            "Median": quartiles[1],
+            "Q75": quartiles[2],
+            "Max": np.nanmax(values, axis=0) if values.shape[0] else np.full(values.shape[1], np.nan)
+        }
+
+def recorded_versions(conn):
+    return dict(conn.execute("SELECT Name, InputVersions FROM rollup_versions;").fetchall())
+
+def record_versions(conn, name, versions):
+    conn.execute("INSERT OR REPLACE INTO rollup_versions (Name, InputVersions) VALUES (?, ?);", (name, versions))
+
+# Recompute stats and vectors for the named annual series, or for every one whose version changed since its
+# rollup was computed. Returns the names that were recomputed.
+def rollup_series(conn, names=None, force=False):
+    versions = store.series_versions(conn)
+    if names is None:
+        names = [row[0] for row in conn.execute("SELECT Name FROM series WHERE Frequency = 'A' ORDER BY SeriesId;")]
+    recorded = recorded_versions(conn)
+    stale = [name for name in names if force or recorded.get(name) != json.dumps(versions[name])]
+    if not stale:
+        return []
+    values, present, state_ids, years = derived.load_matrix(conn, stale)
+    kinds = dict(conn.execute("SELECT StateId, Name = ? OR Kind != 'state' FROM states;", (us,)).fetchall())
+    included = np.array([not kinds[int(state)] for state in state_ids], dtype=bool)
+    for i, name in enumerate(stale):
+        series = store.series_id(conn, name)
+        conn.execute("DELETE FROM rollup_stats WHERE SeriesId = ?;", (series,))
+        conn.execute("DELETE FROM rollup_vectors WHERE SeriesId = ?;", (series,))
+        stats = summary_stats(values[i][included])
+        has_data = present[i].any(axis=0)
+        conn.executemany("INSERT INTO rollup_stats (SeriesId, Year, "+", ".join(stat_names)+") VALUES (?, ?"+", ?"*len(stat_names)+");",
+            [(series, int(years[c]), int(stats["N"][c])) + tuple(sql_float(stats[stat][c]) for stat in stat_names[1:])
+                for c in np.flatnonzero(has_data)])
+        vectors = []
+        for c in np.flatnonzero(has_data):
+            rows = np.flatnonzero(present[i][:, c])
+            vectors.append((series, year_axis, int(years[c]), state_ids[rows].astype(np.int64).tobytes(), values[i][rows, c].tobytes()))
+        for s in np.flatnonzero(present[i].any(axis=1)):
+            columns = np.flatnonzero(present[i][s])
+            vectors.append((series, state_axis, int(state_ids[s]), years[columns].astype(np.int64).tobytes(), values[i][s, columns].tobytes()))
+        conn.executemany("INSERT INTO rollup_vectors (SeriesId, Axis, Key, Keys, Vals) VALUES (?, ?, ?, ?, ?);", vectors)
+        record_versions(conn, name, json.dumps(versions[name]))
+    return stale
+
+# Recompute the stored variance decomposition if any of its inputs changed. Returns whether it was recomputed.
+def rollup_decomposition(conn, force=False):
+    import decompose
+    from panel import Panel
+    names = decompose.sector_series()
+    versions = store.series_versions(conn)
+    if any(name not in versions for name in names):
+        return False
+    current = derived.input_versions(names, versions)
+    if not force and recorded_versions(conn).get(decomposition_name) == current:
+        return False
+    values, present, state_ids, years = derived.load_matrix(conn, names)
+    state_names = dict(conn.execute("SELECT StateId, Name FROM states;").fetchall())
+    if not len(years) or us not in state_names.values():
+        return False
+    result = decompose.decompose_states(Panel(values, names, [state_names[int(state)] for state in state_ids], years))
+    conn.execute("DELETE FROM rollup_decomposition;")
+    conn.executemany("INSERT INTO rollup_decomposition (Year, Variance, ConstantShares, ConstantRates, WithinShare, BetweenShare) \
+        VALUES (?, ?, ?, ?, ?, ?);", [(int(row[0]),) + tuple(sql_float(value) for value in row[1:]) for row in result.itertuples(index=False)])
+    record_versions(conn, decomposition_name, current)
+    return True
+
+# Bring every rollup up to date. Returns the series that were recomputed.
+@instrument.timed("rollup")
+def refresh(conn, force=False):
+    create_tables(conn)
+    changed = rollup_series(conn, force=force)
+    rollup_decomposition(conn, force)
+    return changed
+
+###### Readers
+
+# Summary stats of a series across states, as a DataFrame indexed by Year.
+def stats(conn, name, years=None):
+    import pandas as pd
+    sql = "SELECT Year, "+", ".join(stat_names)+" FROM rollup_stats WHERE SeriesId = ?"
+    params = [store.series_id(conn, name)]
+    if years is not None:
+        years = [int(year) for year in years]
+        sql += " AND Year IN ("+", ".join("?"*len(years))+")"
+        params += years
+    instrument.count("queries")
+    return pd.DataFrame(conn.execute(sql+" ORDER BY Year;", params).fetchall(), columns=["Year"]+stat_names).set_index("Year")
+
+# Variance across states of a series in each of the given years, NaN where there is no data.
+def variance(conn, name, years):
+    found = stats(conn, name, years)["Variance"]
+    return np.array([found.get(int(year), np.nan) for year in years], dtype=float)
+
+def vector(conn, name, axis, key):
+    row = conn.execute("SELECT Keys, Vals FROM rollup_vectors WHERE SeriesId = ? AND Axis = ? AND Key = ?;", (store.series_id(conn, name), axis, int(key))).fetchone()
+    instrument.count("queries")
+    if row is None:
+        return np.zeros(0, np.int64), np.zeros(0)
+    return np.frombuffer(row[0], np.int64), np.frombuffer(row[1], np.float64)
+
+# Several series in one year, as a DataFrame indexed by State, like panel.Panel.cross_section.
+def cross_section(conn, names, year, exclude=(us,)):
+    import pandas as pd
+    state_names = dict(conn.execute("SELECT StateId, Name FROM states;").fetchall())
+    columns = {}
+    for name in names:
+        keys, values = vector(conn, name, year_axis, year)
+        columns[name] = pd.Series(values, index=[state_names[int(key)] for key in keys])
+    df = pd.DataFrame(columns)
+    df = df.loc[[state for state in df.index if state not in exclude]]
+    df.index.name = "State"
+    return df
+
+# One series for one state, indexed by year.
+def state_series(conn, name, state=us):
+    import pandas as pd
+    row = conn.execute("SELECT StateId FROM states WHERE Name = ?;", (state,)).fetchone()
+    if row is None:
+        raise KeyError("Unknown state: "+str(state))
+    keys, values = vector(conn, name, state_axis, row[0])
+    return pd.Series(values, index=keys, name=name)
+
+# The stored cross-state variance decomposition, in the form returned by decompose.decompose_states.
+def decomposition(conn, years=None):
+    import pandas as pd
+    sql = "SELECT Year, Variance, ConstantShares, ConstantRates, WithinShare, BetweenShare FROM rollup_decomposition"
+    params = []
+    if years is not None:
+        years = [int(year) for year in years]
+        sql += " WHERE Year IN ("+", ".join("?"*len(years))+")"
+        params = years
+    instrument.count("queries")
+    df = pd.DataFrame(conn.execute(sql+" ORDER BY Year;", params).fetchall(),
+        columns=["Year", "Variance", "ConstantShares", "ConstantRates", "WithinShare", "BetweenShare"])
+    return df.astype({column: float for column in df.columns if column != "Year"})
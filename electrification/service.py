@@ -0,0 +1,251 @@
+# Read-only HTTP/JSON query service over the database, for dashboards and notebooks.
+#   GET /series                              every series with its frequency and version
+#   GET /series/<name>?state=<state>         one annual series for one state (default: the US), by year
+#   GET /cross-section?series=<a>&year=<y>   annual series across states in one year; repeat series for several
+#   GET /stats/<name>[?year=<y>]             summary stats across states, from the rollup tables
+# The database is switched to WAL once at startup, so readers never block a rebuild writing to it and see the
+# last committed data while it runs. Requests share a pool of read-only connections (mode=ro); the queries are
+# fixed SQL strings, so each connection prepares a statement once and reuses it from the sqlite3 statement cache.
+# Responses carry an ETag made from the data version (every series version and rollup version) and the request.
+# A request whose If-None-Match matches is answered 304 without running a query, and other repeats are served
+# from a response cache until the data changes. The data version is only re-read on a connection after
+# PRAGMA data_version shows another connection has committed.
+
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+import instrument
+import store
+from panel import us
+
+pool_size = 8 # Read-only connections
+cache_entries = 1024 # Responses kept in the response cache
+
+series_sql = "SELECT Name, Frequency, Version FROM series ORDER BY SeriesId;"
+state_series_sql = "SELECT o.Year, o.Value FROM observations AS o \
+    JOIN series ON o.SeriesId = series.SeriesId JOIN states ON o.StateId = states.StateId \
+    WHERE series.Name = ? AND states.Name = ? ORDER BY o.Year;"
+cross_section_sql = "SELECT states.Name, o.Value FROM observations AS o \
+    JOIN series ON o.SeriesId = series.SeriesId JOIN states ON o.StateId = states.StateId \
+    WHERE series.Name = ? AND o.Year = ? ORDER BY states.Name;"
+stats_sql = "SELECT r.Year, r.N, r.Mean, r.Variance, r.Min, r.Q25, r.Median, r.Q75, r.Max FROM rollup_stats AS r \
+    JOIN series ON r.SeriesId = series.SeriesId WHERE series.Name = ? ORDER BY r.Year;"
+stats_columns = ["Year", "N", "Mean", "Variance", "Min", "Q25", "Median", "Q75", "Max"]
+version_sql = "SELECT Name, Version FROM series ORDER BY Name;"
+rollup_version_sql = "SELECT Name, InputVersions FROM rollup_versions ORDER BY Name;"
+
+class NotFound(Exception):
+    pass
+
+class BadRequest(Exception):
+    pass
+
+# Put the database in WAL mode. The mode is kept in the file, so this needs write access only once.
+def enable_wal(path):
+    if not os.path.exists(path):
+        raise FileNotFoundError("No database at "+path)
+    conn = store.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL;")
+    finally:
+        conn.close()
+
+# A read-only connection with the data version last seen on it.
+class Reader:
+    def __init__(self, path):
+        self.conn = sqlite3.connect("file:"+quote(os.path.abspath(path))+"?mode=ro", uri=True, check_same_thread=False)
+        self.conn.execute("PRAGMA query_only = ON;")
+        self.data_version = None
+        self.version = None
+
+    # Hash of every series version and rollup version, re-read only after another connection has committed.
+    def current_version(self):
+        data_version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+        if data_version != self.data_version or self.version is None:
+            versions = self.conn.execute(version_sql).fetchall()
+            try:
+                versions += self.conn.execute(rollup_version_sql).fetchall()
+            except sqlite3.OperationalError: # No rollup tables yet
+                pass
+            self.version = hashlib.sha1(json.dumps(versions).encode()).hexdigest()[:16]
+            self.data_version = data_version
+        return self.version
+
+class Pool:
+    def __init__(self, path, size=pool_size):
+        self.path = path
+        self.idle = queue.LifoQueue()
+        self.slots = threading.Semaphore(size)
+        self.readers = []
+
+    @contextmanager
+    def reader(self):
+        with self.slots:
+            try:
+                reader = self.idle.get_nowait()
+            except queue.Empty:
+                reader = Reader(self.path)
+                self.readers.append(reader)
+            try:
+                yield reader
+            finally:
+                self.idle.put(reader)
+
+    def close(self):
+        for reader in self.readers:
+            reader.conn.close()
+
+###### Queries
+
+def series_list(conn, params):
+    return [{"name": name, "frequency": frequency, "version": version} for name, frequency, version in conn.execute(series_sql)]
+
+def require_series(conn, name):
+    try:
+        store.series_id(conn, name)
+    except KeyError as e:
+        raise NotFound(e.args[0])
+
+def state_series(conn, name, params):
+    state = params.get("state", [us])[0]
+    rows = conn.execute(state_series_sql, (name, state)).fetchall()
+    if not rows:
+        require_series(conn, name)
+    return {"series": name, "state": state, "years": [row[0] for row in rows], "values": [row[1] for row in rows]}
+
+def cross_section(conn, params):
+    names = params.get("series")
+    if not names or "year" not in params:
+        raise BadRequest("cross-section needs series and year")
+    try:
+        year = int(params["year"][0])
+    except ValueError:
+        raise BadRequest("year must be an integer")
+    columns = {}
+    for name in names:
+        rows = conn.execute(cross_section_sql, (name, year)).fetchall()
+        if not rows:
+            require_series(conn, name)
+        columns[name] = dict(rows)
+    states = sorted(set().union(*columns.values()))
+    return {"year": year, "states": states, "values": {name: [column.get(state) for state in states] for name, column in columns.items()}}
+
+def stats(conn, name, params):
+    try:
+        rows = conn.execute(stats_sql, (name,)).fetchall()
+    except sqlite3.OperationalError: # No rollup tables yet
+        raise NotFound("No rollups in this database; run build or refresh")
+    if not rows:
+        require_series(conn, name)
+    if "year" in params:
+        try:
+            years = {int(year) for year in params["year"]}
+        except ValueError:
+            raise BadRequest("year must be an integer")
+        rows = [row for row in rows if row[0] in years]
+    return {"series": name, "stats": [dict(zip(stats_columns, row)) for row in rows]}
+
+# Answer a request path, as a JSON-serializable result.
+def query(conn, path, params):
+    parts = [unquote(part) for part in path.strip("/").split("/")]
+    if parts == ["series"]:
+        return series_list(conn, params)
+    if len(parts) == 2 and parts[0] == "series":
+        return state_series(conn, parts[1], params)
+    if parts == ["cross-section"]:
+        return cross_section(conn, params)
+    if len(parts) == 2 and parts[0] == "stats":
+        return stats(conn, parts[1], params)
+    raise NotFound("Unknown path: "+path)
+
+###### Server
+
+class Service(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, path=store.db_path, connections=pool_size):
+        enable_wal(path)
+        self.pool = Pool(path, connections)
+        self.cache = OrderedDict() # Request target -> (ETag, body)
+        self.cache_lock = threading.Lock()
+        super().__init__(address, Handler)
+
+    def cached(self, target, etag):
+        with self.cache_lock:
+            entry = self.cache.get(target)
+            if entry is None or entry[0] != etag:
+                return None
+            self.cache.move_to_end(target)
+            return entry[1]
+
+    def store_response(self, target, etag, body):
+        with self.cache_lock:
+            self.cache[target] = (etag, body)
+            self.cache.move_to_end(target)
+            while len(self.cache) > cache_entries:
+                self.cache.popitem(last=False)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, so clients reuse connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        instrument.count("service_requests")
+        split = urlsplit(self.path)
+        target = split.path+"?"+split.query if split.query else split.path # Parameter order sets column order
+        server = self.server
+        try:
+            with server.pool.reader() as reader:
+                etag = '"'+reader.current_version()+"-"+hashlib.sha1(target.encode()).hexdigest()[:12]+'"'
+                if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                    instrument.count("service_not_modified")
+                    return self.respond(304, None, etag)
+                body = server.cached(target, etag)
+                if body is not None:
+                    instrument.count("service_cache_hits")
+                else:
+                    body = json.dumps(query(reader.conn, split.path, parse_qs(split.query))).encode()
+                    server.store_response(target, etag, body)
+            self.respond(200, body, etag)
+        except NotFound as e:
+            self.respond(404, json.dumps({"error": str(e)}).encode())
+        except BadRequest as e:
+            self.respond(400, json.dumps({"error": str(e)}).encode())
+        except sqlite3.Error as e:
+            self.respond(503, json.dumps({"error": str(e)}).encode())
+
+    def respond(self, status, body, etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache") # Clients revalidate with If-None-Match
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# Serve the database until interrupted.
+def serve(path=None, host="127.0.0.1", port=8000, connections=pool_size):
+    path = path or store.db_path
+    with Service((host, port), path, connections) as server:
+        print("Serving "+path+" on http://"+host+":"+str(server.server_address[1])+"/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
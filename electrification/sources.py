@@ -0,0 +1,59 @@
+# EIA data sources beyond the annual state-level SEDS series.
+# A Source knows how to name a series from a dataset and a geography code, the frequency of its data, and the
+# kind of geography it covers. Frequencies:
+#   A  annual   periods like "2019", stored by Year in observations
+#   M  monthly  periods like "201901", stored as Period timestamps in partition tables (see store.py)
+#   H  hourly   periods like "20190101T05Z" or "20190101T05-08", stored the same way
+# Period timestamps are integer seconds since 1970 (UTC) at the start of the period.
+
+import numpy as np
+
+frequencies = ["A", "M", "H"]
+
+class Source:
+    def __init__(self, pattern, frequency, kind="state"):
+        if frequency not in frequencies:
+            raise ValueError("Unknown frequency: "+str(frequency))
+        self.pattern = pattern
+        self.frequency = frequency
+        self.kind = kind
+
+    # EIA series id for a dataset and geography code, e.g. SEDS.TETCB.CA.A
+    def series_id(self, dataset, code):
+        return self.pattern.format(dataset=dataset, code=code)
+
+    # Every (geography, dataset, table) combination, for geographies given as {name: code}.
+    def jobs(self, geographies, series):
+        return [(geography, dataset, table) for geography in geographies for dataset, table in series]
+
+sources = {
+    "seds": Source("SEDS.{dataset}.{code}.A", "A"), # State Energy Data System, e.g. TETCB for total energy
+    "electricity_monthly": Source("ELEC.{dataset}.{code}-ALL.M", "M"), # Retail SALES, PRICE, REVENUE by state
+    "grid_hourly": Source("EBA.{code}-ALL.{dataset}.H", "H", kind="balancing_authority") # D for demand, NG for generation
+}
+
+# Period strings as integer timestamps, or as years for annual data.
+def parse_periods(periods, frequency):
+    periods = [str(period) for period in periods]
+    if frequency == "A":
+        return np.array([int(period[:4]) for period in periods], dtype=np.int64)
+    if frequency == "M":
+        months = np.array([period[:4]+"-"+period[4:6] for period in periods], dtype="datetime64[M]")
+        return months.astype("datetime64[s]").astype(np.int64)
+    if frequency == "H":
+        hours = np.array([period[:4]+"-"+period[4:6]+"-"+period[6:8]+"T"+period[9:11] for period in periods], dtype="datetime64[h]")
+        offsets = np.array([utc_offset(period[11:]) for period in periods], dtype=np.int64)
+        return hours.astype("datetime64[s]").astype(np.int64) - offsets
+    raise ValueError("Unknown frequency: "+str(frequency))
+
+# Seconds east of UTC for a suffix like "Z", "-08" or "+0530".
+def utc_offset(suffix):
+    if suffix in ("", "Z"):
+        return 0
+    sign = -1 if suffix[0] == "-" else 1
+    digits = suffix[1:].replace(":", "")
+    return sign*(int(digits[:2])*3600 + int(digits[2:4] or 0)*60)
+
+# Calendar years of integer timestamps.
+def period_years(periods):
+    return np.asarray(periods, dtype=np.int64).astype("datetime64[s]").astype("datetime64[Y]").astype(np.int64) + 1970
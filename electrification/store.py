@@ -0,0 +1,334 @@
+# Storage for the EIA data.
+# Every series is kept in one fact table, observations, keyed by (SeriesId, StateId, Year) with integer ids for
+# series and states. The primary key clusters each series by state and year, and a covering index on
+# (SeriesId, Year, StateId, Value) serves single-year cross sections, so a multi-series pull is a range scan.
+# Views under the old table names expose the familiar (State, Year, Value) columns for existing queries.
+# Monthly and hourly series (see sources.py) are kept in partition tables keyed by (SeriesId, StateId, Period),
+# with Period in seconds since 1970 UTC: observations_m_<decade> and observations_h_<year>. Each partition stays
+# small enough that inserts and range reads cost the same however many partitions there are.
+# The states table holds every geography, with Kind telling states from other areas such as balancing authorities.
+# Exports and figures written from the database record what they were made from in JSON manifests next to them.
+
+import json
+import os
+import sqlite3
+import tempfile
+import numpy as np
+import instrument
+import sources
+
+db_path = "eia.db"
+
+# Every series in the database, downloaded or derived.
+series_names = [
+    "electricity",
+    "energy",
+    "end_use_energy",
+    "electrification",
+    "electricity_price",
+    "energy_price",
+    "energy_price_share",
+    "electricity_price_share",
+    "gdp",
+    "population",
+    "gdp_per_capita",
+    "electricity_imports",
+    "residential_energy",
+    "residential_electricity",
+    "residential_electrification",
+    "commercial_energy",
+    "commercial_electricity",
+    "commercial_electrification",
+    "industrial_energy",
+    "industrial_electricity",
+    "industrial_electrification",
+    "transportation_energy",
+    "transportation_electricity",
+    "transportation_electrification",
+    "electric_energy",
+    "electric_electricity",
+    "electric_electrification",
+    "transportation_share",
+    "industrial_share",
+    "commercial_share",
+    "residential_share",
+    "electric_share"
+]
+
+upsert_clause = "ON CONFLICT (SeriesId, StateId, Year) DO UPDATE SET Value = excluded.Value WHERE Value IS NOT excluded.Value"
+period_upsert_clause = "ON CONFLICT (SeriesId, StateId, Period) DO UPDATE SET Value = excluded.Value WHERE Value IS NOT excluded.Value"
+partition_years = {"M": 10, "H": 1} # Years covered by one partition table, by frequency
+
+def connect(path=db_path):
+    return sqlite3.connect(path)
+
+def create_schema(conn):
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS series( \
+        SeriesId INTEGER PRIMARY KEY, \
+        Name VARCHAR(64) NOT NULL UNIQUE, \
+        Version int NOT NULL DEFAULT 0, \
+        InputVersions TEXT, \
+        Frequency CHAR(1) NOT NULL DEFAULT 'A' \
+    );")
+    cur.execute("CREATE TABLE IF NOT EXISTS states( \
+        StateId INTEGER PRIMARY KEY, \
+        Name VARCHAR(32) NOT NULL UNIQUE, \
+        Kind VARCHAR(32) NOT NULL DEFAULT 'state' \
+    );")
+    cur.execute("CREATE TABLE IF NOT EXISTS observations( \
+        SeriesId int NOT NULL, \
+        StateId int NOT NULL, \
+        Year int NOT NULL, \
+        Value FLOAT, \
+        PRIMARY KEY (SeriesId, StateId, Year) \
+    ) WITHOUT ROWID;")
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(series);")]
+    if "Version" not in columns: # Databases created before series were versioned
+        cur.execute("ALTER TABLE series ADD COLUMN Version int NOT NULL DEFAULT 0;")
+        cur.execute("ALTER TABLE series ADD COLUMN InputVersions TEXT;")
+    if "Frequency" not in columns: # Databases created before monthly and hourly series
+        cur.execute("ALTER TABLE series ADD COLUMN Frequency CHAR(1) NOT NULL DEFAULT 'A';")
+    if "Kind" not in [row[1] for row in cur.execute("PRAGMA table_info(states);")]:
+        cur.execute("ALTER TABLE states ADD COLUMN Kind VARCHAR(32) NOT NULL DEFAULT 'state';")
+    cur.execute("CREATE INDEX IF NOT EXISTS observations_by_year ON observations (SeriesId, Year, StateId, Value);")
+    rename_states(conn)
+    for name in series_names:
+        add_series(conn, name)
+
+# State names that were stored misspelled by earlier builds, and their corrections.
+renamed_states = {"Indiania": "Indiana"}
+
+# Correct misspelled state names, bumping the version of every series with rows for a renamed state so that
+# anything keyed by name (derived series, rollups, exports) is brought up to date.
+def rename_states(conn):
+    for old, new in renamed_states.items():
+        row = conn.execute("SELECT StateId FROM states WHERE Name = ?;", (old,)).fetchone()
+        if row is None or conn.execute("SELECT 1 FROM states WHERE Name = ?;", (new,)).fetchone() is not None:
+            continue
+        conn.execute("UPDATE states SET Name = ? WHERE StateId = ?;", (new, row[0]))
+        conn.execute("UPDATE series SET Version = Version + 1 WHERE SeriesId IN (SELECT DISTINCT SeriesId FROM observations WHERE StateId = ?);", (row[0],))
+
+# Bring a database written by an older version up to the current schema. Cheap when there is nothing to do,
+# so readers call it before relying on newer columns.
+def upgrade(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(series);")]
+    if columns and "Frequency" not in columns:
+        create_schema(conn)
+        conn.commit()
+    elif columns and conn.execute("SELECT 1 FROM states WHERE Name IN ("+", ".join("?"*len(renamed_states))+");", list(renamed_states)).fetchone():
+        rename_states(conn)
+        conn.commit()
+
+# Register a series and give an annual series a compatibility view. Tables left over from the
+# one-table-per-series layout are moved into observations first.
+def add_series(conn, name, frequency="A"):
+    if frequency not in sources.frequencies:
+        raise ValueError("Unknown frequency: "+str(frequency))
+    cur = conn.cursor()
+    cur.execute("INSERT OR IGNORE INTO series (Name, Frequency) VALUES (?, ?);", (name, frequency))
+    series = series_id(conn, name)
+    if frequency != "A":
+        return series
+    kind = cur.execute("SELECT type FROM sqlite_master WHERE name = ?;", (name,)).fetchone()
+    if kind is not None and kind[0] == "table":
+        old_rows = cur.execute("SELECT State, Year, Value FROM "+name+";").fetchall()
+        write_rows(conn, name, old_rows)
+        cur.execute("DROP TABLE "+name+";")
+        kind = None
+    if kind is None:
+        cur.execute("CREATE VIEW "+name+" AS \
+            SELECT states.Name AS State, observations.Year AS Year, observations.Value AS Value \
+            FROM observations JOIN states ON observations.StateId = states.StateId \
+            WHERE observations.SeriesId = "+str(series)+";")
+    return series
+
+def series_id(conn, name):
+    row = conn.execute("SELECT SeriesId FROM series WHERE Name = ?;", (name,)).fetchone()
+    if row is None:
+        raise KeyError("Unknown series: "+name)
+    return row[0]
+
+def series_frequency(conn, name):
+    row = conn.execute("SELECT Frequency FROM series WHERE Name = ?;", (name,)).fetchone()
+    if row is None:
+        raise KeyError("Unknown series: "+name)
+    return row[0]
+
+# Ids of the named states, or other geographies of the given kind, adding any that are new.
+# New names get ids in the order they first appear, so identical builds give identical ids.
+def state_ids(conn, names, kind="state"):
+    names = dict.fromkeys(names)
+    conn.executemany("INSERT OR IGNORE INTO states (Name, Kind) VALUES (?, ?);", [(name, kind) for name in names])
+    return {name: state for state, name in conn.execute("SELECT StateId, Name FROM states;") if name in names}
+
+# Write (state, year, value) rows to a series with one executemany.
+# With upsert, existing values are replaced by revised ones instead of being ignored.
+# Returns the number of rows actually changed.
+def write_rows(conn, name, rows, upsert=False, kind="state"):
+    series = series_id(conn, name)
+    ids = state_ids(conn, [row[0] for row in rows], kind)
+    return write_id_rows(conn, series, [(series, ids[state], year, value) for state, year, value in rows], upsert)
+
+# Write (SeriesId, StateId, Year, Value) rows that all belong to one series, bumping its version if anything changed.
+def write_id_rows(conn, series, rows, upsert=False):
+    before = conn.total_changes
+    conn.executemany("INSERT "+("" if upsert else "OR IGNORE ")+"INTO observations (SeriesId, StateId, Year, Value) VALUES (?, ?, ?, ?) "
+        +(upsert_clause if upsert else "")+";", rows)
+    changes = conn.total_changes - before
+    instrument.count("rows_written", changes)
+    if changes:
+        conn.execute("UPDATE series SET Version = Version + 1 WHERE SeriesId = ?;", (series,))
+    return changes
+
+# Delete (StateId, Year) cells from a series, bumping its version if anything was removed.
+def delete_cells(conn, series, cells):
+    before = conn.total_changes
+    conn.executemany("DELETE FROM observations WHERE SeriesId = ? AND StateId = ? AND Year = ?;",
+        [(series, state, year) for state, year in cells])
+    changes = conn.total_changes - before
+    instrument.count("rows_deleted", changes)
+    if changes:
+        conn.execute("UPDATE series SET Version = Version + 1 WHERE SeriesId = ?;", (series,))
+    return changes
+
+# Version counters by series name. A series' version goes up whenever its rows change.
+def series_versions(conn):
+    return {name: version for name, version in conn.execute("SELECT Name, Version FROM series;")}
+
+# Several series in one indexed scan, as a DataFrame with one column per series.
+# Rows are indexed by (State, Year); the year or state level is dropped when that argument is given.
+def load_series(conn, names, year=None, state=None):
+    import pandas as pd
+    ids = {series_id(conn, name): name for name in names}
+    sql = "SELECT observations.SeriesId, states.Name, observations.Year, observations.Value \
+        FROM observations JOIN states ON observations.StateId = states.StateId \
+        WHERE observations.SeriesId IN ("+", ".join("?"*len(ids))+")"
+    params = list(ids)
+    if year is not None:
+        sql += " AND observations.Year = ?"
+        params.append(int(year))
+    if state is not None:
+        sql += " AND states.Name = ?"
+        params.append(state)
+    rows = conn.execute(sql+";", params).fetchall()
+    instrument.count("queries")
+    instrument.count("rows_read", len(rows))
+    df = pd.DataFrame(rows, columns=["Series", "State", "Year", "Value"])
+    df["Series"] = df["Series"].map(ids)
+    df = df.pivot(index=["State", "Year"], columns="Series", values="Value").reindex(columns=list(names))
+    df.columns.name = None
+    if year is not None:
+        df = df.droplevel("Year")
+    elif state is not None:
+        df = df.droplevel("State")
+    return df
+
+###### Monthly and hourly series
+
+# Partition table holding a frequency's periods in a given calendar year.
+def partition_table(frequency, year):
+    span = partition_years[frequency]
+    return "observations_"+frequency.lower()+"_"+str(int(year)//span*span)
+
+def create_partition(conn, table):
+    conn.execute("CREATE TABLE IF NOT EXISTS "+table+"( \
+        SeriesId int NOT NULL, \
+        StateId int NOT NULL, \
+        Period int NOT NULL, \
+        Value FLOAT, \
+        PRIMARY KEY (SeriesId, StateId, Period) \
+    ) WITHOUT ROWID;")
+
+# Existing partitions of a frequency as (first year, table name), in order.
+def partitions(conn, frequency):
+    prefix = "observations_"+frequency.lower()+"_"
+    names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?;", (prefix+"%",))]
+    return sorted((int(name[len(prefix):]), name) for name in names if name[len(prefix):].isdigit())
+
+# Write (geography, period, value) rows to a monthly or hourly series, with periods as integer timestamps.
+# Rows are split by partition and written in key order, one executemany per partition.
+# With upsert, existing values are replaced by revised ones. Returns the number of rows changed.
+def write_period_rows(conn, name, rows, upsert=False, kind="state"):
+    series = series_id(conn, name)
+    frequency = series_frequency(conn, name)
+    if frequency == "A":
+        raise ValueError(name+" is an annual series; use write_rows")
+    if not rows:
+        return 0
+    ids = state_ids(conn, [row[0] for row in rows], kind)
+    geography = np.array([ids[row[0]] for row in rows], dtype=np.int64)
+    period = np.array([row[1] for row in rows], dtype=np.int64)
+    value = [row[2] for row in rows]
+    years = sources.period_years(period)
+    span = partition_years[frequency]
+    part = years//span
+    order = np.lexsort((period, geography, part))
+    before = conn.total_changes
+    for chunk in np.split(order, np.flatnonzero(np.diff(part[order])) + 1):
+        table = partition_table(frequency, years[chunk[0]])
+        create_partition(conn, table)
+        conn.executemany("INSERT "+("" if upsert else "OR IGNORE ")+"INTO "+table+" (SeriesId, StateId, Period, Value) VALUES (?, ?, ?, ?) "
+            +(period_upsert_clause if upsert else "")+";",
+            [(series, int(geography[i]), int(period[i]), value[i]) for i in chunk])
+    changes = conn.total_changes - before
+    instrument.count("rows_written", changes)
+    if changes:
+        conn.execute("UPDATE series SET Version = Version + 1 WHERE SeriesId = ?;", (series,))
+    return changes
+
+# Monthly or hourly series between two timestamps (start inclusive, end exclusive), as a DataFrame with one
+# column per series, indexed by (State, Period) with Period as a UTC datetime. Only partitions that overlap
+# the range are read. All the named series must have the same frequency.
+def load_periods(conn, names, start=None, end=None, states=None):
+    import pandas as pd
+    ids = {series_id(conn, name): name for name in names}
+    frequency = {series_frequency(conn, name) for name in names}
+    if len(frequency) != 1 or "A" in frequency:
+        raise ValueError("load_periods needs monthly or hourly series of one frequency")
+    frequency = frequency.pop()
+    span = partition_years[frequency]
+    first = None if start is None else int(sources.period_years([start])[0])
+    last = None if end is None else int(sources.period_years([end-1])[0])
+    where = " WHERE p.SeriesId IN ("+", ".join("?"*len(ids))+")"
+    params = list(ids)
+    if start is not None:
+        where += " AND p.Period >= ?"
+        params.append(int(start))
+    if end is not None:
+        where += " AND p.Period < ?"
+        params.append(int(end))
+    if states is not None:
+        where += " AND states.Name IN ("+", ".join("?"*len(states))+")"
+        params += list(states)
+    rows = []
+    for year, table in partitions(conn, frequency):
+        if (first is not None and year+span <= first) or (last is not None and year > last):
+            continue
+        rows += conn.execute("SELECT p.SeriesId, states.Name, p.Period, p.Value FROM "+table+" AS p \
+            JOIN states ON p.StateId = states.StateId"+where+";", params).fetchall()
+        instrument.count("queries")
+    instrument.count("rows_read", len(rows))
+    df = pd.DataFrame(rows, columns=["Series", "State", "Period", "Value"])
+    df["Series"] = df["Series"].map(ids)
+    df["Period"] = pd.to_datetime(df["Period"], unit="s", utc=True)
+    df = df.pivot(index=["State", "Period"], columns="Series", values="Value").reindex(columns=list(names))
+    df.columns.name = None
+    return df
+
+###### Manifests
+
+# A JSON manifest, or default when there is none or it cannot be read.
+def read_manifest(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+# Write a JSON manifest atomically, so readers see either the old one or the new one.
+def write_manifest(path, manifest):
+    handle, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix="."+os.path.basename(path)+".")
+    with os.fdopen(handle, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
@@ -0,0 +1,231 @@
+# Data validation during ingest and derivation, and for the whole database.
+# Every check is an array operation over a batch of rows or a (state, year) matrix:
+#   unknown_table     rows for a table that is not a registered series, or a derived series with such an input
+#   non_finite        infinite values
+#   range             values outside the range their units allow (see ranges)
+#   zero_denominator  ratio cells whose denominator is zero, which derived.py stores as NULL
+#   coverage          (state, year) cells with no value, between the first and last year a series has data
+#   empty             registered series with no rows at all
+# Findings are recorded as they are found, like instrument.py counters. Each is a dict with the check, its
+# severity (error, warning or info), the stage that found it (ingest, derive or database), the series, the
+# number of cells and a sample of them. report() returns every finding with totals, as JSON-ready data.
+# check_database() validates everything stored with a fixed handful of queries, reading observations once.
+
+import json
+import threading
+import time
+import numpy as np
+import instrument
+import store
+
+sample_size = 10 # Cells listed per finding
+
+nonnegative = (0, None)
+fraction = (0, 1)
+
+# Series name -> (low, high) allowed values; None leaves that side open. Series not listed are not range checked.
+ranges = {
+    "electricity": nonnegative,
+    "energy": nonnegative,
+    "end_use_energy": nonnegative,
+    "electricity_price": nonnegative,
+    "energy_price": nonnegative,
+    "gdp": nonnegative,
+    "population": nonnegative,
+    "residential_energy": nonnegative,
+    "residential_electricity": nonnegative,
+    "commercial_energy": nonnegative,
+    "commercial_electricity": nonnegative,
+    "industrial_energy": nonnegative,
+    "industrial_electricity": nonnegative,
+    "transportation_energy": nonnegative,
+    "transportation_electricity": nonnegative,
+    "electric_energy": nonnegative,
+    "electric_electricity": (0, 0), # Filled with zeros by build_db
+    "electricity_price_share": nonnegative,
+    "gdp_per_capita": nonnegative,
+    "electrification": fraction,
+    "residential_electrification": fraction,
+    "commercial_electrification": fraction,
+    "industrial_electrification": fraction,
+    "transportation_electrification": fraction,
+    "electric_electrification": fraction,
+    "transportation_share": fraction,
+    "industrial_share": fraction,
+    "commercial_share": fraction,
+    "residential_share": fraction,
+    "electric_share": fraction
+}
+
+# Ratios whose zero denominators are known and harmless; reported as info rather than warnings.
+expected_zero_denominators = {"electric_electrification"}
+
+findings = []
+lock = threading.Lock()
+
+def reset():
+    with lock:
+        findings.clear()
+
+def record(check, severity, stage, series, count, sample):
+    finding = {"check": check, "severity": severity, "stage": stage, "series": series, "count": int(count), "sample": sample}
+    with lock:
+        findings.append(finding)
+    return finding
+
+def errors():
+    with lock:
+        return sum(finding["severity"] == "error" for finding in findings)
+
+def report():
+    with lock:
+        totals = {}
+        for finding in findings:
+            total = totals.setdefault(finding["check"], {"findings": 0, "cells": 0})
+            total["findings"] += 1
+            total["cells"] += finding["count"]
+        return {
+            "generated": time.time(),
+            "errors": sum(finding["severity"] == "error" for finding in findings),
+            "warnings": sum(finding["severity"] == "warning" for finding in findings),
+            "totals": totals,
+            "findings": [dict(finding) for finding in findings]
+        }
+
+def summary():
+    data = report()
+    return str(len(data["findings"]))+" findings, "+str(data["errors"])+" errors, "+str(data["warnings"])+" warnings"
+
+def write_report(path):
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=1)
+
+# Plain Python values for JSON, with NaN and infinities as None.
+def as_json(value):
+    value = value.item() if isinstance(value, np.generic) else value
+    return None if isinstance(value, float) and not np.isfinite(value) else value
+
+# Up to sample_size [key, key, value] triples for the cells where mask is set in a (key, key) array.
+def sample_cells(mask, rows, columns, values=None):
+    cells = np.argwhere(mask)[:sample_size]
+    return [[as_json(rows[r]), as_json(columns[c])] + ([] if values is None else [as_json(values[r, c])]) for r, c in cells]
+
+###### Checks
+
+# Range and non-finite checks on a (state, year) array of a series. NaN cells are treated as missing.
+def check_values(name, values, states, years, stage):
+    found = []
+    infinite = np.isinf(values)
+    if infinite.any():
+        found.append(record("non_finite", "warning", stage, name, infinite.sum(), sample_cells(infinite, states, years, values)))
+    if name in ranges:
+        low, high = ranges[name]
+        with np.errstate(invalid="ignore"):
+            outside = np.zeros(values.shape, bool)
+            if low is not None:
+                outside |= values < low
+            if high is not None:
+                outside |= values > high
+        outside &= np.isfinite(values)
+        if outside.any():
+            found.append(record("range", "warning", stage, name, outside.sum(), sample_cells(outside, states, years, values)))
+    return found
+
+# Cells with no value in a (state, year) presence array, between the first and last year any state has data.
+def check_coverage(name, has_value, states, years, stage):
+    columns = np.flatnonzero(has_value.any(axis=0))
+    if not len(columns):
+        return [record("empty", "warning", stage, name, 0, [])]
+    span = slice(columns[0], columns[-1]+1)
+    missing = ~has_value[:, span]
+    if not missing.any():
+        return []
+    return [record("coverage", "warning", stage, name, missing.sum(), sample_cells(missing, states, years[span]))]
+
+# Ratio cells with both inputs present and a zero denominator, for (state, year) arrays.
+def check_denominator(name, denominator, mask, states, years, stage):
+    zero = mask & (denominator == 0)
+    if not zero.any():
+        return []
+    severity = "info" if name in expected_zero_denominators else "warning"
+    return [record("zero_denominator", severity, stage, name, zero.sum(), sample_cells(zero, states, years))]
+
+# Check a batch of (state, year, value) rows for one table before it is written. Tables that are not
+# registered series are recorded as errors. With coverage, missing (state, year) cells are looked for across
+# states, or the states in the batch when states is None; rows keyed by period rather than year skip this.
+# Returns whether the table is known.
+def check_rows(conn, table, rows, stage="ingest", states=None, coverage=True):
+    if conn.execute("SELECT 1 FROM series WHERE Name = ?;", (table,)).fetchone() is None:
+        record("unknown_table", "error", stage, table, len(rows), [[row[0], row[1]] for row in rows[:sample_size]])
+        return False
+    if not rows:
+        return True
+    keys = np.array([row[1] for row in rows], dtype=np.int64)
+    values = np.array([np.nan if row[2] is None else row[2] for row in rows], dtype=float)
+    labels = sorted(set(states if states is not None else []) | {row[0] for row in rows})
+    index = {label: i for i, label in enumerate(labels)}
+    rows_index = np.array([index[row[0]] for row in rows], dtype=np.int64)
+    columns, columns_index = np.unique(keys, return_inverse=True)
+    if coverage:
+        columns = np.arange(columns[0], columns[-1]+1)
+        columns_index = keys - columns[0]
+    matrix = np.full((len(labels), len(columns)), np.nan)
+    matrix[rows_index, columns_index] = values
+    check_values(table, matrix, labels, columns, stage)
+    if coverage:
+        check_coverage(table, ~np.isnan(matrix), labels, columns, stage)
+    return True
+
+# Derived series whose inputs are not registered series, recorded as errors. Returns their names.
+def check_specs(conn, specs, stage="derive"):
+    known = {row[0] for row in conn.execute("SELECT Name FROM series;")} | set(specs)
+    bad = []
+    for name, (op, inputs) in specs.items():
+        unknown = [source for source in inputs if source not in known]
+        if unknown:
+            record("unknown_table", "error", stage, name, 0, unknown)
+            bad.append(name)
+    return bad
+
+# Validate every annual series in the database, reading each table once. Returns the report.
+def check_database(conn, specs=None):
+    if specs is None:
+        import derived
+        specs = derived.derived_series
+    store.upgrade(conn)
+    series = conn.execute("SELECT SeriesId, Name FROM series WHERE Frequency = 'A' ORDER BY SeriesId;").fetchall()
+    states = conn.execute("SELECT StateId, Name, Kind = 'state' FROM states ORDER BY StateId;").fetchall()
+    rows = conn.execute("SELECT SeriesId, StateId, Year, Value FROM observations;").fetchall()
+    instrument.count("queries", 3)
+    instrument.count("rows_read", len(rows))
+    data = np.array(rows, dtype=float).reshape(-1, 4)
+    check_specs(conn, specs, "database")
+
+    series_ids = np.array([row[0] for row in series], dtype=np.int64)
+    names = [row[1] for row in series]
+    state_ids = np.array([row[0] for row in states], dtype=np.int64)
+    state_names = [row[1] for row in states]
+    is_state = np.array([bool(row[2]) for row in states], dtype=bool)
+    years = np.arange(int(data[:, 2].min()), int(data[:, 2].max())+1) if len(data) else np.arange(0)
+    values = np.full((len(names), len(state_ids), len(years)), np.nan)
+    present = np.zeros(values.shape, bool)
+    if len(data) and len(names):
+        series_index = np.full(max(series_ids.max(), int(data[:, 0].max()))+1, -1)
+        series_index[series_ids] = np.arange(len(series_ids))
+        state_index = np.full(max(state_ids.max(), int(data[:, 1].max()))+1, -1)
+        state_index[state_ids] = np.arange(len(state_ids))
+        s, g = series_index[data[:, 0].astype(int)], state_index[data[:, 1].astype(int)]
+        keep = (s >= 0) & (g >= 0) # Rows of monthly or hourly series, or of deleted states, are not checked here
+        cell = (s[keep], g[keep], data[keep, 2].astype(int) - years[0])
+        values[cell] = data[keep, 3]
+        present[cell] = True
+
+    for i, name in enumerate(names):
+        check_values(name, values[i], state_names, years, "database")
+        check_coverage(name, present[i][is_state] & ~np.isnan(values[i][is_state]), [state for state, keep in zip(state_names, is_state) if keep], years, "database")
+    index = {name: i for i, name in enumerate(names)}
+    for name, (op, inputs) in specs.items():
+        if op == "ratio" and all(source in index for source in inputs):
+            a, b = index[inputs[0]], index[inputs[1]]
+            check_denominator(name, values[b], present[a] & present[b], state_names, years, "database")
+    return report()